@@ -1,15 +1,19 @@
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 from dotenv import load_dotenv
 import background_tasks
-import database
+import live_config
+import metrics
 import middleware
+import request_timing
+import resolver_stats
 from textwrap import dedent
 
 load_dotenv()
-resolvers = database.get_dns_resolvers()
-domain_ignorelist = database.get_ignorelist()
+live_config.load()
+live_config.start_reloading()  # resolvers and ignorelist are picked up without restarting
+resolver_stats.start_publishing()  # the scheduler merges the probe statistics of all workers
 app = Flask(__name__)
-background_tasks.launch(resolvers)
+background_tasks.launch()
 
 
 @app.route('/')
@@ -18,17 +22,40 @@ def index():
     <h2>API Endpoints</h2>
     <h3>GET /test_domain?domain=example.com</h3>
     <p>Testet ob eine Domain geblockt ist</p>
+    <h3>POST /test_domains</h3>
+    <p>Testet mehrere Domains gleichzeitig. Body: JSON Liste der Domains, Antwort: eine JSON Zeile pro Domain (NDJSON)</p>
     <h3>GET /resolvers</h3>
     <p>Gibt alle DNS Resolver zurück, die wir zum testen von Domains benutzen</p>
     <h3>GET /blocked_domains</h3>
     <p>Gibt alle geblockten Domains zurück</p>
+    <h3>GET /blocked_domains/changes?since=0</h3>
+    <p>Gibt alle Änderungen der Liste nach der Sequenznummer since zurück (next ist der Cursor für die nächste Abfrage)</p>
+    <h3>GET /blocked_domains/history?domain=example.com</h3>
+    <p>Gibt den Verlauf der Sperrungen einer Domain pro Provider zurück (isps ist der aktuelle Stand)</p>
+    <h3>GET /blocked_domains/export/(txt|hosts|ndjson|bloom)</h3>
+    <p>Gibt alle geblockten Domains als Textliste, Hosts-Datei, NDJSON oder Bloom-Filter zurück (Format siehe README)</p>
+    <h3>GET /metrics</h3>
+    <p>Prometheus Metriken (DNS Probes, Datenbank, Webhooks, Hintergrund-Checks)</p>
     ''')
 
 
 @app.route('/test_domain')
 def test_domain():
     domain = request.args.get('domain')
-    return middleware.test_domain(domain, resolvers, domain_ignorelist)
+    return middleware.test_domain(domain, live_config.get_resolvers(), live_config.get_ignorelist())
+
+
+@app.route('/test_domains', methods=['POST'])
+def test_domains():
+    domains = request.get_json(silent=True)
+    if isinstance(domains, dict):
+        domains = domains.get('domains')
+    if not isinstance(domains, list):
+        return {"error": "Expected a JSON list of domains"}
+    return Response(
+        stream_with_context(middleware.test_domains(domains, live_config.get_resolvers(), live_config.get_ignorelist())),
+        mimetype='application/x-ndjson'
+    )
 
 
 @app.route('/add_domain')
@@ -45,7 +72,43 @@ def get_resolvers():
 
 @app.route('/blocked_domains')
 def get_blocked_domains():
-    return middleware.get_blocked_domains()
+    return middleware.get_blocked_domains(request.if_none_match, 'gzip' in request.accept_encodings)
+
+
+@app.route('/blocked_domains/export/<export_format>')
+def export_blocked_domains(export_format):
+    return middleware.get_blocked_domains(request.if_none_match, 'gzip' in request.accept_encodings, export_format)
+
+
+@app.route('/blocked_domains/changes')
+def get_blocklist_changes():
+    return middleware.get_blocklist_changes(request.args.get('since'), request.args.get('limit'))
+
+
+@app.route('/blocked_domains/history')
+def get_blocking_history():
+    return middleware.get_blocking_history(request.args.get('domain'))
+
+
+@app.route('/metrics')
+def get_metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+@app.before_request
+def start_timing():
+    request_timing.start_request(request)
+
+
+@app.after_request
+def add_server_timing(response):
+    return request_timing.finish_request(request, response)
+
+
+@app.teardown_request
+def stop_profiling(exception):
+    request_timing.teardown_request(request)
 
 
 @app.after_request
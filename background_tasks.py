@@ -1,21 +1,26 @@
 import asyncio
+import heapq
+import os
 import threading
+import time
+from datetime import datetime
 
+import blocking_history
 import data_types as t
 import database
 import dns
+import live_config
+import loop_thread
+import metrics
 import notifications
-
-resolver_healths: list[t.HealthCheckResponse] = []
-
-
-def get_resolver_health() -> list[t.HealthCheckResponse]:
-    return resolver_healths
+import resolver_stats
+import shared_state
+from sweep_matrix import SweepMatrix
 
 
 async def update_resolver_health(resolvers: list[t.DNSResolver]):
     res = await dns.run_full_check("damcraft.de", resolvers)
-    resolver_healths.clear()
+    resolver_healths: list[t.HealthCheckResponse] = []
     for result in res.responses:
         response = result.response
         status = t.ResolverHealth.REACHABLE
@@ -24,43 +29,242 @@ async def update_resolver_health(resolvers: list[t.DNSResolver]):
         elif response == t.SingleProbeResponseType.TIMEOUT:
             status = t.ResolverHealth.UNREACHABLE
         resolver_healths.append(t.HealthCheckResponse(result.resolver, status, result.duration))
+        resolver_stats.record_health(result.resolver.address, status == t.ResolverHealth.REACHABLE)
+    workers = resolver_stats.read_workers()
+    shared_state.publish("resolvers", [
+        {
+            "resolver": health.resolver.name,
+            "isp": health.resolver.isp,
+            "protocol": health.resolver.address.protocol,
+            "health": health.health.name,
+            "ping": health.ping,
+            "obeys_cuii": health.resolver.is_blocking,
+            # latency percentiles and loss rate over the recent probes of all workers, uptime over the recent
+            # health checks
+            **resolver_stats.get_stats(health.resolver.address, workers)
+        }
+        for health in resolver_healths
+    ])
+    # addresses aren't part of the public list above, the circuit breakers of every worker are fed from this
+    shared_state.publish("health", {
+        "updated_at": time.time(),
+        "resolvers": {str(health.resolver.address): health.health.name for health in resolver_healths}
+    })
 
 
-async def update_dns_blocklist(resolvers: list[t.DNSResolver]):
-    # Update the blocklist database
-    domains = database.get_blocked_domains()  # forgive me for calling this blocking function from an async context
-    # blocking_instances = database.get_blocking_instances()  # sowwy
+class _Entry:
+    # revalidation state of one blocked domain
+    __slots__ = ("due", "interval", "last_result", "recent")
+
+    def __init__(self, recent: bool):
+        self.due = 0.0  # loop time of the next check
+        self.interval = _min_interval()
+        self.last_result: t.FullProbeResponseType | None = None
+        self.recent = recent  # added recently, checked at the minimum interval
+
+
+# Instead of rechecking every blocked domain every minute, each domain has its own interval and the scheduler
+# checks the most overdue ones first, as many as the probe budget allows. Domains that stay blocked back off up to
+# SWEEP_MAX_INTERVAL, domains that were just added or whose result changed are checked every SWEEP_MIN_INTERVAL.
+_entries: dict[str, _Entry] = {}
+_queue: list[tuple[float, str]] = []  # heap of (due, domain), entries whose due changed since are skipped
+
+
+def _min_interval() -> float:
+    return float(os.getenv("SWEEP_MIN_INTERVAL", "60"))
+
+
+def _is_recent(domain: t.BlockedDomain) -> bool:
+    if domain.first_blocked_on is None:
+        return False
+    window = float(os.getenv("SWEEP_RECENT_WINDOW", "86400"))
+    return (datetime.now() - domain.first_blocked_on).total_seconds() < window
+
+
+def _schedule(domain: str, entry: _Entry, due: float):
+    entry.due = due
+    heapq.heappush(_queue, (due, domain))
+
+
+async def refresh_domains():
+    # picks up domains added (by any worker) or removed since the last refresh, new ones are due immediately
+    domains = await database.get_blocked_domains_async()
+    now = asyncio.get_event_loop().time()
+    current = {domain.domain for domain in domains}
     for domain in domains:
-        results = await dns.run_full_check(domain.domain, resolvers)
+        entry = _entries.get(domain.domain)
+        if entry is None:
+            entry = _entries[domain.domain] = _Entry(_is_recent(domain))
+            _schedule(domain.domain, entry, now)
+        else:
+            entry.recent = _is_recent(domain)
+    for domain in [domain for domain in _entries if domain not in current]:
+        del _entries[domain]
+    blocking_history.retain(current)
+    # drop stale heap entries once they make up most of the queue
+    if len(_queue) > 2 * len(_entries) + 64:
+        _queue[:] = [(entry.due, domain) for domain, entry in _entries.items()]
+        heapq.heapify(_queue)
+
+
+def _is_stale(due: float, domain: str) -> bool:
+    entry = _entries.get(domain)
+    return entry is None or entry.due != due
+
+
+def _oldest_due() -> float | None:
+    while _queue and _is_stale(*_queue[0]):
+        heapq.heappop(_queue)
+    return _queue[0][0] if _queue else None
+
+
+def _take_due(now: float, limit: int) -> list[str]:
+    due = []
+    while _queue and len(due) < limit and _queue[0][0] <= now:
+        entry_due, domain = heapq.heappop(_queue)
+        if not _is_stale(entry_due, domain):
+            due.append(domain)
+    return due
 
+
+def _reschedule(domain: str, result: t.FullProbeResponseType, now: float):
+    entry = _entries[domain]
+    max_interval = float(os.getenv("SWEEP_MAX_INTERVAL", "3600"))
+    if result == entry.last_result == t.FullProbeResponseType.BLOCKED and not entry.recent:
+        entry.interval = min(max_interval, entry.interval * 2)  # stable, back off
+    else:
+        entry.interval = _min_interval()  # new, flipped, partial or errors
+    entry.last_result = result
+    _schedule(domain, entry, now + entry.interval)
+
+
+async def revalidate(resolvers: list[t.DNSResolver], budget: int) -> int:
+    # checks up to budget due domains, most overdue first, and returns how many were checked
+    now = asyncio.get_event_loop().time()
+    domains = _take_due(now, budget)
+    if not domains:
+        return 0
+    # blocking_instances = database.get_blocking_instances()  # sowwy
+    try:
+        return await _revalidate(domains, resolvers, now)
+    except BaseException:
+        # domains that weren't rescheduled or removed are due again right away, instead of dropping out of the queue
+        retry_at = asyncio.get_event_loop().time()
+        for domain in domains:
+            entry = _entries.get(domain)
+            if entry is not None and entry.due <= now:
+                _schedule(domain, entry, retry_at)
+        raise
+
+
+async def _revalidate(domains: list[str], resolvers: list[t.DNSResolver], now: float) -> int:
+    # check many domains at once, but never have more than SWEEP_RESOLVER_CONCURRENCY probes in flight per resolver
+    domain_limit = asyncio.Semaphore(int(os.getenv("SWEEP_CONCURRENCY", "32")))
+    resolver_concurrency = int(os.getenv("SWEEP_RESOLVER_CONCURRENCY", "8"))
+    resolver_limits = {resolver.address: asyncio.Semaphore(resolver_concurrency) for resolver in resolvers}
+    matrix = SweepMatrix(domains, resolvers)  # outcome codes and latencies instead of response objects
+
+    async def check(row: int):
+        async with domain_limit:
+            await asyncio.gather(*(probe(row, column) for column in range(len(resolvers))))
+
+    async def probe(row: int, column: int):
+        resolver = resolvers[column]
+        response, duration = await dns.probe(domains[row], resolver, resolver_limits[resolver.address])
+        matrix.set(row, column, response, duration)
+
+    await asyncio.gather(*(check(row) for row in range(len(domains))))
+
+    unblocked: list[str] = []
+    check_time = asyncio.get_event_loop().time()
+    for row, final_result in enumerate(matrix.classify_all()):
+        domain = domains[row]
+        blocking_history.record(domain, resolvers, matrix.row(row))
         # if all ISPs have not blocked the domain, remove the domain from the blocklist
-        if results.final_result == t.FullProbeResponseType.NOT_BLOCKED:
-            notifications.domain_unblocked(domain.domain)
-            database.remove_blocked_domain(domain.domain)
-            continue
+        if final_result == t.FullProbeResponseType.NOT_BLOCKED:
+            unblocked.append(domain)
+        elif domain in _entries:  # may have been removed by a refresh meanwhile
+            _reschedule(domain, final_result, check_time)
+    await blocking_history.flush()  # the per-ISP state changes of this batch in one write
+    timeouts = matrix.timeouts()
 
+    # all removals of this batch in one transaction
+    await database.remove_blocked_domains_async(unblocked)
+    blocking_history.forget(unblocked)  # flushed above, the final NOT_BLOCKED rows are already written
+    for domain in unblocked:
+        _entries.pop(domain, None)
+        notifications.domain_unblocked(domain)
 
-async def background_loop(resolvers: list[t.DNSResolver]):
+    duration = asyncio.get_event_loop().time() - now
+    metrics.SWEEP_DURATION.observe(duration)
+    rate = len(domains) / duration if duration > 0 else 0.0
+    print(f"Revalidated {len(domains)} of {len(_entries) + len(unblocked)} domains in {duration:.2f}s "
+          f"({rate:.1f} domains/s), {len(unblocked)} unblocked, timeouts per resolver: {timeouts}")
+    shared_state.publish("sweep", {
+        "finished_at": time.time(),
+        "domains": len(domains),
+        "tracked": len(_entries),
+        "duration": duration,
+        "timeouts": timeouts,
+        "latencies": matrix.median_latencies()  # median ms of the answered probes per resolver
+    })
+    return len(domains)
+
+
+async def health_loop():
+    interval = float(os.getenv("HEALTH_INTERVAL", "60"))
+    while True:
+        start_time = asyncio.get_event_loop().time()
+        try:
+            await update_resolver_health(live_config.get_resolvers())
+        except Exception as e:  # e.g. the state file couldn't be written, try again next time
+            print(f"Error checking resolver health: {e!r}")
+        elapsed = asyncio.get_event_loop().time() - start_time
+        await asyncio.sleep(max(0.0, interval - elapsed))
+
+
+async def revalidation_loop():
+    # every SWEEP_TICK seconds the due domains are checked, limited to SWEEP_PROBE_BUDGET probes per minute
+    tick = float(os.getenv("SWEEP_TICK", "5"))
+    refresh_interval = float(os.getenv("SWEEP_REFRESH_INTERVAL", "30"))
+    probe_budget = int(os.getenv("SWEEP_PROBE_BUDGET", "6000"))
+    last_refresh = None
     while True:
         start_time = asyncio.get_event_loop().time()
-        await update_resolver_health(resolvers)
-        await update_dns_blocklist(resolvers)
+        # a failed step (database, state file) is logged and retried next tick, the loop must keep running as long
+        # as this process holds the scheduler lock
+        try:
+            await blocking_history.load()  # once, retried until it succeeds
+            if last_refresh is None or start_time - last_refresh >= refresh_interval:
+                await refresh_domains()
+                last_refresh = start_time
+            resolvers = live_config.get_resolvers()  # the current set, it may have been reloaded
+            budget = max(1, int(probe_budget * tick / 60) // max(1, len(resolvers)))  # full checks this tick
+            await revalidate(resolvers, budget)
+        except Exception as e:
+            print(f"Error revalidating blocked domains: {e!r}")
 
+        # how far the most overdue domain is behind its schedule, grows when the budget is too small
         end_time = asyncio.get_event_loop().time()
-        await asyncio.sleep(60 - (end_time - start_time))  # 60 seconds - time taken
+        oldest_due = _oldest_due()
+        metrics.SWEEP_LAG.set(max(0.0, end_time - oldest_due) if oldest_due is not None else 0.0)
+        await asyncio.sleep(max(0.0, tick - (end_time - start_time)))
 
 
-def launch(resolvers: list[t.DNSResolver]):
-    try:
-        asyncio.get_running_loop()
-        asyncio.create_task(background_loop(resolvers))
-    except RuntimeError:  # No running event loop
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.create_task(background_loop(resolvers))
-
-        def run_loop(loop_):
-            loop_.run_forever()
-
-        thread = threading.Thread(target=run_loop, args=(loop,), daemon=True)
-        thread.start()
+async def background_loop():
+    # resolver health and blocklist revalidation run independently of each other
+    await asyncio.gather(health_loop(), revalidation_loop())
+
+
+def launch():
+    # Every worker calls this, but only the one holding the scheduler lock runs the loop.
+    # The others wait on the lock and take over if the scheduler process dies.
+    # The loop is the worker's shared probe loop, so background and user probes use the same sockets.
+    def run_scheduler():
+        shared_state.acquire_scheduler_lock()
+        print(f"Process {os.getpid()} is now running the background tasks")
+        future = loop_thread.submit(background_loop())
+        future.add_done_callback(lambda f: print(f"Background tasks stopped: {f.exception()!r}"))
+
+    thread = threading.Thread(target=run_scheduler, daemon=True)
+    thread.start()
@@ -0,0 +1,73 @@
+from datetime import datetime
+
+import data_types as t
+import database
+
+__all__ = ["load", "record", "flush", "forget", "retain"]
+
+# Per-(domain, ISP) blocking timeline. The background revalidation feeds every checked domain in here, a row is only
+# written to blocking_history when an ISP's state differs from the last known one, and all rows of a batch are
+# written at once. Only used by the scheduler process, on its event loop.
+_last_states: dict[str, dict[str, t.BlockingState]] | None = None  # domain -> isp -> state
+_pending: list[t.BlockingStateChange] = []
+
+
+async def load():
+    # the last known states, once per process
+    global _last_states
+    if _last_states is None:
+        states = await database.get_blocking_states_async()
+        _last_states = {}
+        for (domain, isp), state in states.items():
+            _last_states.setdefault(domain, {})[isp] = state
+
+
+_ANSWERED = {t.SingleProbeResponseType.BLOCKED.value, t.SingleProbeResponseType.NOT_BLOCKED.value}
+
+
+def _isp_states(resolvers: list[t.DNSResolver], codes: bytes) -> dict[str, t.BlockingState]:
+    # an ISP blocks a domain if any of its resolvers does. ISPs whose resolvers all failed have no state this time
+    # codes are the SingleProbeResponseType values of one sweep matrix row, in the order of resolvers
+    states: dict[str, t.BlockingState] = {}
+    for resolver, code in zip(resolvers, codes):
+        if not resolver.is_blocking or not resolver.isp or code not in _ANSWERED:
+            continue
+        if code == t.SingleProbeResponseType.BLOCKED.value:
+            states[resolver.isp] = t.BlockingState.BLOCKED
+        else:
+            states.setdefault(resolver.isp, t.BlockingState.NOT_BLOCKED)
+    return states
+
+
+def record(domain: str, resolvers: list[t.DNSResolver], codes: bytes):
+    now = datetime.now()
+    for isp, state in _isp_states(resolvers, codes).items():
+        last_states = _last_states.setdefault(domain, {})
+        if last_states.get(isp) != state:
+            last_states[isp] = state
+            _pending.append(t.BlockingStateChange(None, domain, isp, state, now))
+
+
+async def flush():
+    # on failure the changes are kept and written with the next batch
+    if not _pending:
+        return
+    changes = _pending[:]
+    try:
+        await database.add_blocking_state_changes_async(changes)
+    except Exception as e:
+        print(f"Error writing blocking history: {e}")
+        return
+    del _pending[:len(changes)]
+
+
+def forget(domains: list[str]):
+    # domains that left the blocklist, their last rows stay in the table. If one is added again, its first
+    # check writes the states again
+    for domain in domains:
+        _last_states.pop(domain, None)
+
+
+def retain(domains: set[str]):
+    # drops every domain that isn't on the blocklist anymore, also those loaded from old history rows
+    forget([domain for domain in _last_states if domain not in domains])
@@ -0,0 +1,105 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+import bloom
+import data_types as t
+import database
+
+__all__ = ["Export", "Snapshot", "get_snapshot"]
+
+# /blocked_domains changes a few times a day but is polled all the time. The list is serialized once into every
+# export format, each with a gzip version and an ETag, and kept in memory. It is only rebuilt when this process
+# changed the list, or when a cheap version query (at most every SNAPSHOT_CHECK_INTERVAL seconds) shows that
+# another process did.
+
+
+class Export:
+    def __init__(self, body: bytes, content_type: str):
+        self.body = body
+        self.gzip_body = gzip.compress(body, 9)
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.content_type = content_type
+
+
+class Snapshot:
+    def __init__(self, version: tuple, local_changes: int, change_seq: int, exports: dict[str, Export]):
+        self.version = version
+        self.local_changes = local_changes
+        self.change_seq = change_seq  # the change feed position the snapshot includes (maybe a bit more)
+        self.exports = exports
+        self.checked_at = time.monotonic()
+        self.stale = False  # the version query showed a change, the next request rebuilds
+
+
+_snapshot: Snapshot | None = None
+_lock = threading.Lock()
+_check_lock = threading.Lock()
+
+
+def _to_dict(blocked_domain: t.BlockedDomain) -> dict[str, str | None]:
+    return {
+        "domain": blocked_domain.domain,
+        # "added_by": blocked_domain.added_by, - removed for now
+        "first_blocked_on": blocked_domain.first_blocked_on.date().isoformat(),
+        "site": blocked_domain.site.name if blocked_domain.site else None,
+    }
+
+
+def _render(blocked_domains: list[t.BlockedDomain]) -> dict[str, Export]:
+    domains = sorted(blocked_domain.domain for blocked_domain in blocked_domains)
+    return {
+        "json": Export(
+            json.dumps([_to_dict(blocked_domain) for blocked_domain in blocked_domains], separators=(",", ":")).encode(),
+            "application/json"
+        ),
+        "txt": Export("".join(f"{domain}\n" for domain in domains).encode(), "text/plain; charset=utf-8"),
+        "hosts": Export("".join(f"0.0.0.0 {domain}\n" for domain in domains).encode(), "text/plain; charset=utf-8"),
+        "ndjson": Export(
+            "".join(json.dumps(_to_dict(blocked_domain)) + "\n" for blocked_domain in blocked_domains).encode(),
+            "application/x-ndjson"
+        ),
+        "bloom": Export(
+            bloom.build(domains, float(os.getenv("BLOOM_FALSE_POSITIVE_RATE", "0.001"))),
+            "application/octet-stream"
+        )
+    }
+
+
+def _is_current(snapshot: Snapshot | None) -> bool:
+    if snapshot is None or snapshot.stale or snapshot.local_changes != database.blocklist_changes:
+        return False
+    interval = float(os.getenv("SNAPSHOT_CHECK_INTERVAL", "10"))
+    if time.monotonic() - snapshot.checked_at < interval:
+        return True
+    # one thread claims the check, the others keep serving the snapshot until it is done
+    with _check_lock:
+        checked_at = snapshot.checked_at
+        if time.monotonic() - checked_at < interval:
+            return True
+        snapshot.checked_at = time.monotonic()
+    try:
+        version = database.get_blocked_domains_version()
+    except BaseException:
+        snapshot.checked_at = checked_at  # the next request tries again
+        raise
+    if version != snapshot.version:
+        snapshot.stale = True
+        return False
+    return True
+
+
+def get_snapshot() -> Snapshot:
+    global _snapshot
+    if _is_current(_snapshot):
+        return _snapshot
+    with _lock:  # only one request thread rebuilds, the others wait for its result
+        if not _is_current(_snapshot):
+            local_changes = database.blocklist_changes
+            version = database.get_blocked_domains_version()
+            change_seq = database.get_latest_blocklist_change()
+            _snapshot = Snapshot(version, local_changes, change_seq, _render(database.get_blocked_domains()))
+        return _snapshot
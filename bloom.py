@@ -0,0 +1,50 @@
+import hashlib
+import math
+import struct
+
+__all__ = ["build", "contains"]
+
+# Compact Bloom filter of the blocklist, so clients can check domains locally.
+#
+# Format (version 2), all integers big-endian:
+#   header, 16 bytes: magic b"CUBF" | version u8 | k u8 | reserved u16 | m u32 (bits) | n u32 (domains)
+#   body: ceil(m / 8) bytes, bit i is (body[i >> 3] >> (i & 7)) & 1
+# Lookup: d = sha256(domain.lower() encoded as UTF-8, without trailing dot),
+#   h1 = (d[0:8] as u64) mod m, h2 = (d[8:16] as u64 with the lowest bit set) mod m, or 1 if that is 0,
+#   the domain is (probably) on the list if the bits (h1 + j * h2) mod m are set for all j in 0..k-1.
+#   h1 and h2 are below m < 2^32 and j < 256, so every step fits into unsigned 64 bit arithmetic.
+MAGIC = b"CUBF"
+VERSION = 2
+HEADER = struct.Struct("!4sBBHII")
+
+
+def _hashes(domain: str, m: int) -> tuple[int, int]:
+    digest = hashlib.sha256(domain.lower().rstrip(".").encode()).digest()
+    return int.from_bytes(digest[0:8], "big") % m, (int.from_bytes(digest[8:16], "big") | 1) % m or 1
+
+
+def build(domains: list[str], false_positive_rate: float = 0.001) -> bytes:
+    n = len(domains)
+    m = max(8, math.ceil(-n * math.log(false_positive_rate) / math.log(2) ** 2))
+    k = max(1, round(m / max(n, 1) * math.log(2)))
+    bits = bytearray(math.ceil(m / 8))
+    for domain in domains:
+        h1, h2 = _hashes(domain, m)
+        for j in range(k):
+            i = (h1 + j * h2) % m
+            bits[i >> 3] |= 1 << (i & 7)
+    return HEADER.pack(MAGIC, VERSION, k, 0, m, n) + bytes(bits)
+
+
+def contains(data: bytes, domain: str) -> bool:
+    # reference lookup, clients implement the same in their language
+    magic, version, k, _, m, _ = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a version {VERSION} CUII Bloom filter")
+    bits = memoryview(data)[HEADER.size:]
+    h1, h2 = _hashes(domain, m)
+    for j in range(k):
+        i = (h1 + j * h2) % m
+        if not bits[i >> 3] & (1 << (i & 7)):
+            return False
+    return True
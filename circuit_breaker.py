@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+
+from async_dns import Address
+
+import data_types as t
+import shared_state
+
+__all__ = ["allow", "record", "record_health", "apply_shared_health", "forget"]
+
+# Per-resolver circuit breaker for the user path. Consecutive failed probes (or an UNREACHABLE health check)
+# open the circuit and user requests skip the resolver. After CIRCUIT_OPEN_SECONDS a few trial probes are let
+# through (half-open), one answer closes the circuit again, one failure reopens it.
+
+
+class _Circuit:
+    def __init__(self):
+        self.state = t.CircuitState.CLOSED
+        self.failures = 0
+        self.changed_at = time.monotonic()
+        self.trials = 0
+
+
+_circuits: dict[Address, _Circuit] = {}
+_lock = threading.Lock()  # may be used from more than one thread
+_applied_health_version = None
+
+
+def _get(address: Address) -> _Circuit:
+    circuit = _circuits.get(address)
+    if circuit is None:
+        circuit = _circuits[address] = _Circuit()
+    return circuit
+
+
+def _set_state(circuit: _Circuit, state: t.CircuitState):
+    circuit.state = state
+    circuit.changed_at = time.monotonic()
+    circuit.trials = 0
+
+
+def allow(address: Address) -> bool:
+    open_seconds = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+    half_open_probes = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", "2"))
+    with _lock:
+        circuit = _get(address)
+        if circuit.state == t.CircuitState.CLOSED:
+            return True
+        elapsed = time.monotonic() - circuit.changed_at
+        if circuit.state == t.CircuitState.OPEN:
+            if elapsed < open_seconds:
+                return False
+            _set_state(circuit, t.CircuitState.HALF_OPEN)
+        elif elapsed >= open_seconds:
+            # trial probes that never reported back (e.g. cancelled), allow new ones
+            _set_state(circuit, t.CircuitState.HALF_OPEN)
+        if circuit.trials >= half_open_probes:
+            return False
+        circuit.trials += 1
+        return True
+
+
+def record(address: Address, answered: bool):
+    threshold = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3"))
+    with _lock:
+        circuit = _get(address)
+        if answered:
+            circuit.failures = 0
+            if circuit.state != t.CircuitState.CLOSED:
+                _set_state(circuit, t.CircuitState.CLOSED)
+            return
+        circuit.failures += 1
+        if circuit.state == t.CircuitState.HALF_OPEN or \
+                (circuit.state == t.CircuitState.CLOSED and circuit.failures >= threshold):
+            _set_state(circuit, t.CircuitState.OPEN)
+
+
+def record_health(address: Address, health: t.ResolverHealth):
+    with _lock:
+        circuit = _get(address)
+        if health == t.ResolverHealth.UNREACHABLE:
+            if circuit.state != t.CircuitState.OPEN:
+                _set_state(circuit, t.CircuitState.OPEN)
+        elif circuit.state == t.CircuitState.OPEN:
+            # it answered the health check, let trial probes decide
+            _set_state(circuit, t.CircuitState.HALF_OPEN)
+
+
+def apply_shared_health(resolvers: list[t.DNSResolver]):
+    # feed the health published by the scheduler process, once per health check
+    global _applied_health_version
+    health = shared_state.read("health")
+    if not health or health.get("updated_at") == _applied_health_version:
+        return
+    _applied_health_version = health.get("updated_at")
+    for resolver in resolvers:
+        state = health["resolvers"].get(str(resolver.address))
+        if state is not None:
+            record_health(resolver.address, t.ResolverHealth[state])
+
+
+def forget(address: Address):
+    with _lock:
+        _circuits.pop(address, None)
@@ -9,6 +9,8 @@ class SingleProbeResponseType(Enum):
     NOT_BLOCKED = 2
     ERROR = 3
     TIMEOUT = 4
+    PENDING = 5  # no answer yet when the full check was decided early
+    SKIPPED = 6  # not probed, the resolver's circuit breaker is open
 
 
 class FullProbeResponseType(Enum):
@@ -17,6 +19,7 @@ class FullProbeResponseType(Enum):
     BLOCKED = 3
     ERROR = 4
     NON_CUII_BLOCK = 5
+    IGNORED = 6  # on the ignorelist, not probed
 
 
 class BlockingType(Enum):
@@ -26,6 +29,8 @@ class BlockingType(Enum):
 
 
 class DNSResolver:
+    __slots__ = ("name", "address", "is_blocking", "isp", "blocking_type")
+
     def __init__(self, name: str, address: Address, is_blocking: bool, isp: str, blocking_type: BlockingType | None):
         self.name = name
         self.address = address
@@ -42,6 +47,8 @@ class DNSResolver:
 
 
 class BlockingInstance:
+    __slots__ = ("domain", "isp", "blocked_on")
+
     def __init__(self, domain: str, isp: str, blocked_on: datetime):
         self.domain = domain
         self.isp = isp
@@ -52,6 +59,8 @@ class BlockingInstance:
 
 
 class BlockedSite:
+    __slots__ = ("name", "recommendation_url", "sitzungsdatum")
+
     def __init__(self, name: str, recommendation_url: str, sitzungsdatum: date):
         self.name = name
         self.recommendation_url = recommendation_url
@@ -59,6 +68,8 @@ class BlockedSite:
 
 
 class BlockedDomain:
+    __slots__ = ("domain", "added_by", "first_blocked_on", "site")
+
     def __init__(self, domain: str, added_by: str | None, first_blocked_on: datetime, site: BlockedSite | None):
         self.domain = domain
         self.added_by = added_by
@@ -66,7 +77,44 @@ class BlockedDomain:
         self.site = site
 
 
+class BlocklistChangeType(Enum):
+    ADDED = 1
+    REMOVED = 2
+    SITE_CHANGED = 3
+
+
+class BlocklistChange:
+    __slots__ = ("seq", "domain", "action", "site_reference", "changed_on")
+
+    def __init__(self, seq: int, domain: str, action: BlocklistChangeType, site_reference: str | None,
+                 changed_on: datetime):
+        self.seq = seq
+        self.domain = domain
+        self.action = action
+        self.site_reference = site_reference
+        self.changed_on = changed_on
+
+
+class BlockingState(Enum):
+    BLOCKED = 1
+    NOT_BLOCKED = 2
+
+
+class BlockingStateChange:
+    # one row of an ISP's blocking timeline for a domain
+    __slots__ = ("seq", "domain", "isp", "state", "changed_on")
+
+    def __init__(self, seq: int | None, domain: str, isp: str, state: BlockingState, changed_on: datetime):
+        self.seq = seq
+        self.domain = domain
+        self.isp = isp
+        self.state = state
+        self.changed_on = changed_on
+
+
 class SingleProbeResponse:
+    __slots__ = ("response", "duration", "domain", "resolver")
+
     def __init__(self, response: SingleProbeResponseType, duration: int, domain: str, resolver: DNSResolver):
         self.response = response
         self.duration = duration
@@ -78,9 +126,13 @@ class SingleProbeResponse:
 
 
 class FullProbeResponse:
-    def __init__(self, responses: list[SingleProbeResponse], final_result: FullProbeResponseType):
+    __slots__ = ("responses", "final_result", "decided_early")
+
+    def __init__(self, responses: list[SingleProbeResponse], final_result: FullProbeResponseType,
+                 decided_early: bool = False):
         self.responses = responses
         self.final_result = final_result
+        self.decided_early = decided_early  # True if some resolvers were still pending when the result was decided
 
 
 class ResolverHealth(Enum):
@@ -89,7 +141,15 @@ class ResolverHealth(Enum):
     ERROR = 3
 
 
+class CircuitState(Enum):
+    CLOSED = 1
+    OPEN = 2
+    HALF_OPEN = 3
+
+
 class HealthCheckResponse:
+    __slots__ = ("resolver", "health", "ping")
+
     def __init__(self, resolver: DNSResolver, health: ResolverHealth, ping: int):
         self.resolver = resolver
         self.health = health
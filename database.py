@@ -38,6 +38,30 @@ CREATE TABLE `blocked_domains` (
   CONSTRAINT `blocked_domains_blocked_sites_name_fk` FOREIGN KEY (`site_reference`) REFERENCES `blocked_sites` (`name`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
 
+CREATE TABLE `blocked_domain_changes` (
+  `seq` bigint(20) NOT NULL AUTO_INCREMENT,
+  `domain` varchar(255) NOT NULL,
+  `action` enum('ADDED','REMOVED','SITE_CHANGED') NOT NULL,
+  `site_reference` varchar(30) DEFAULT NULL,
+  `changed_on` timestamp NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (`seq`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
+
+CREATE TABLE `blocked_domain_changes_lock` (
+  `id` tinyint(1) NOT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci COMMENT 'one row, serializes the writers of blocked_domain_changes'
+
+CREATE TABLE `blocking_history` (
+  `seq` bigint(20) NOT NULL AUTO_INCREMENT,
+  `domain` varchar(255) NOT NULL,
+  `isp` varchar(255) NOT NULL,
+  `state` enum('BLOCKED','NOT_BLOCKED') NOT NULL,
+  `changed_on` timestamp NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (`seq`),
+  KEY `blocking_history_domain_isp_index` (`domain`,`isp`,`seq`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
+
 CREATE TABLE `isp` (
   `name` varchar(255) NOT NULL,
   PRIMARY KEY (`name`)
@@ -51,27 +75,49 @@ CREATE TABLE `blocked_sites` (
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci
 """  # noinspection
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
 from threading import Lock
+import asyncio
 import os
+import time
 
+from mysql.connector.errors import PoolError
 from mysql.connector.pooling import PooledMySQLConnection
 
 import data_types as t
+import metrics
 from mysql.connector import pooling
 
 __all__ = [
     "get_connection",
     "get_dns_resolvers",
+    "get_config_version",
     "get_blocked_domains",
+    "get_blocked_domains_version",
+    "get_blocklist_changes",
+    "get_latest_blocklist_change",
 #    "get_blocking_instances",
     "add_blocked_domain",
     # "add_blocking_instance",
     # "add_blocking_instances",
     # "remove_blocking_instance",
-    "remove_blocked_domain"
+    "remove_blocked_domain",
+    "remove_blocked_domains",
+    "get_blocking_states",
+    "get_blocking_history",
+    "add_blocking_state_changes",
+    "get_blocked_domains_async",
+    "remove_blocked_domains_async",
+    "get_blocking_states_async",
+    "add_blocking_state_changes_async"
 ]
 
 
+# incremented whenever this process changes blocked_domains, cached views of the list compare against it
+blocklist_changes = 0
+
+
 # Singleton class to manage database connection
 class DatabaseConnection:
     _instance = None
@@ -89,8 +135,10 @@ class DatabaseConnection:
         if DatabaseConnection._instance is not None:
             raise Exception("This class is a singleton!")  # Prevent creating a new instance
         else:
+            # one connection per request thread (launch.sh: --threads 32) is the most mysql-connector allows,
+            # callers beyond that wait in get_connection
             self._pool = pooling.MySQLConnectionPool(
-                pool_size=10,
+                pool_size=int(os.getenv("DB_POOL_SIZE", "32")),
                 user=os.getenv("DB_USER"),
                 password=os.getenv("DB_PASS"),
                 host=os.getenv("DB_HOST"),
@@ -98,13 +146,37 @@ class DatabaseConnection:
             )
 
     def get_connection(self) -> PooledMySQLConnection:
-        return self._pool.get_connection()
+        # the pool doesn't block when it is exhausted, so retry until a connection is returned or the timeout passes
+        with metrics.timed(metrics.DB_POOL_WAIT):
+            deadline = time.monotonic() + float(os.getenv("DB_POOL_TIMEOUT", "10"))
+            delay = 0.005
+            while True:
+                try:
+                    return self._pool.get_connection()
+                except PoolError:
+                    if time.monotonic() + delay > deadline:
+                        raise
+                    time.sleep(delay)
+                    delay = min(delay * 2, 0.1)
 
 
 def get_connection() -> PooledMySQLConnection:
     return DatabaseConnection.get_instance().get_connection()
 
 
+def _timed(func):
+    # records the latency of every call in metrics.DB_QUERY_LATENCY, labeled with the function name
+    histogram = metrics.DB_QUERY_LATENCY.labels(func.__name__)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with metrics.timed(histogram):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+@_timed
 def get_dns_resolvers() -> list[t.DNSResolver]:
     # table: dns_resolvers
     # columns: name, ip, is_blocking, isp
@@ -135,6 +207,7 @@ def get_dns_resolvers() -> list[t.DNSResolver]:
     return resolvers
 
 
+@_timed
 def get_blocked_domains() -> list[t.BlockedDomain]:
     # table: blocked_domains
     # columns: domain, added_by, first_blocked_on, site_reference
@@ -165,6 +238,37 @@ def get_blocked_domains() -> list[t.BlockedDomain]:
     return blocked_domains
 
 
+@_timed
+def get_config_version() -> tuple[tuple[int, int], tuple[int, int]]:
+    # cheap fingerprints of dns_resolvers and domain_ignorelist, to notice when they have to be reloaded
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            """
+            SELECT COUNT(*),
+                   COALESCE(BIT_XOR(CRC32(CONCAT_WS('|', ip, name, is_blocking, isp, protocol, blocking_type))), 0)
+            FROM dns_resolvers
+        """)
+        resolvers_count, resolvers_checksum = cursor.fetchone()
+        cursor.execute("SELECT COUNT(*), COALESCE(BIT_XOR(CRC32(domain)), 0) FROM domain_ignorelist")
+        ignorelist_count, ignorelist_checksum = cursor.fetchone()
+    return (int(resolvers_count), int(resolvers_checksum)), (int(ignorelist_count), int(ignorelist_checksum))
+
+
+@_timed
+def get_blocked_domains_version() -> tuple[int, int]:
+    # cheap fingerprint of blocked_domains, changes whenever a domain is added, removed or reassigned
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            """
+            SELECT COUNT(*), COALESCE(BIT_XOR(CRC32(CONCAT_WS('|', domain, site_reference, first_blocked_on))), 0)
+            FROM blocked_domains
+        """)
+        count, checksum = cursor.fetchone()
+    return int(count), int(checksum)
+
+
 # def get_blocking_instances() -> list[t.BlockingInstance]:
 #     # table: blocking_instances
 #     # columns: domain, blocker, blocked_on
@@ -177,8 +281,36 @@ def get_blocked_domains() -> list[t.BlockedDomain]:
 #     return blocking_instances
 
 
+def _lock_change_log(cursor):
+    # Held until the transaction ends. Without it two transactions could take seq numbers in one order and commit
+    # in the other, and a client that already read the higher seq would never see the lower one.
+    # The row is created on first use.
+    cursor.execute(
+        """
+                INSERT INTO blocked_domain_changes_lock (id) VALUES (1)
+                ON DUPLICATE KEY UPDATE id = id
+                """
+    )
+
+
+def _log_blocklist_change(cursor, domain: str, action: t.BlocklistChangeType, site_reference: str | None):
+    # must run in the same transaction as the change itself
+    _lock_change_log(cursor)
+    cursor.execute(
+        """
+                INSERT INTO blocked_domain_changes (domain, action, site_reference)
+                VALUES (%s, %s, %s)
+                """,
+        (domain, action.name, site_reference)
+    )
+
+
+@_timed
 def add_blocked_domain(blocked_domain: t.BlockedDomain) -> bool:
     # returns True if the domain was added, False if it already exists
+    # if it exists and a different site is given, the domain is reassigned to that site
+    global blocklist_changes
+    site_reference = blocked_domain.site.name if blocked_domain.site else None
     with get_connection() as connection:
         cursor = connection.cursor()
         if blocked_domain.site:
@@ -195,11 +327,27 @@ def add_blocked_domain(blocked_domain: t.BlockedDomain) -> bool:
                     INSERT IGNORE INTO blocked_domains (domain, added_by, first_blocked_on, site_reference)
                     VALUES (%s, %s, %s, %s)
                     """,
-            (blocked_domain.domain, blocked_domain.added_by, blocked_domain.first_blocked_on,
-             blocked_domain.site.name if blocked_domain.site else None)
+            (blocked_domain.domain, blocked_domain.added_by, blocked_domain.first_blocked_on, site_reference)
         )
+        is_new = cursor.rowcount > 0  # if the row was added, rowcount will be 1
+        changed = is_new
+        if is_new:
+            _log_blocklist_change(cursor, blocked_domain.domain, t.BlocklistChangeType.ADDED, site_reference)
+        elif site_reference:
+            cursor.execute(
+                """
+                    UPDATE blocked_domains SET site_reference = %s
+                    WHERE domain = %s AND NOT site_reference <=> %s
+                    """,
+                (site_reference, blocked_domain.domain, site_reference)
+            )
+            if cursor.rowcount > 0:
+                changed = True
+                _log_blocklist_change(cursor, blocked_domain.domain, t.BlocklistChangeType.SITE_CHANGED, site_reference)
         connection.commit()
-        return cursor.rowcount > 0  # if the row was added, rowcount will be 1
+        if changed:
+            blocklist_changes += 1
+        return is_new
 
 
 # def add_blocking_instance(blocking_instance: t.BlockingInstance):
@@ -242,24 +390,130 @@ def add_blocked_domain(blocked_domain: t.BlockedDomain) -> bool:
 
 
 def remove_blocked_domain(domain: str):
+    remove_blocked_domains([domain])
+
+
+@_timed
+def remove_blocked_domains(domains: list[str]):
+    # removes all domains in one transaction
+    global blocklist_changes
+    if not domains:
+        return
+    placeholders = ", ".join(["%s"] * len(domains))
     with get_connection() as connection:
         cursor = connection.cursor()
-        # delete the domain from the blocked_domains and blocking_instances tables
         cursor.execute(
-            """
-                    DELETE FROM blocking_instances WHERE domain = %s
+            f"SELECT domain FROM blocked_domains WHERE domain IN ({placeholders}) FOR UPDATE",
+            tuple(domains)
+        )
+        removed = [domain for domain, in cursor.fetchall()]
+        # delete the domains from the blocked_domains and blocking_instances tables
+        cursor.execute(
+            f"""
+                    DELETE FROM blocking_instances WHERE domain IN ({placeholders})
                     """,
-            (domain,)
+            tuple(domains)
         )
+        cursor.execute(
+            f"""
+                    DELETE FROM blocked_domains WHERE domain IN ({placeholders})
+                    """,
+            tuple(domains)
+        )
+        if removed:
+            _lock_change_log(cursor)
+            cursor.executemany(
+                """
+                    INSERT INTO blocked_domain_changes (domain, action, site_reference)
+                    VALUES (%s, %s, NULL)
+                    """,
+                [(domain, t.BlocklistChangeType.REMOVED.name) for domain in removed]
+            )
+        connection.commit()
+        blocklist_changes += 1
+
+
+@_timed
+def get_blocklist_changes(since: int, limit: int) -> list[t.BlocklistChange]:
+    # changes with a sequence number greater than since, oldest first
+    with get_connection() as connection:
+        cursor = connection.cursor()
         cursor.execute(
             """
-                    DELETE FROM blocked_domains WHERE domain = %s
+            SELECT seq, domain, action, site_reference, changed_on
+            FROM blocked_domain_changes
+            WHERE seq > %s
+            ORDER BY seq
+            LIMIT %s
+        """, (since, limit))
+        results = cursor.fetchall()
+    return [
+        t.BlocklistChange(seq, domain, t.BlocklistChangeType[action], site_reference, changed_on)
+        for seq, domain, action, site_reference, changed_on in results
+    ]
+
+
+@_timed
+def get_latest_blocklist_change() -> int:
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM blocked_domain_changes")
+        seq, = cursor.fetchone()
+    return int(seq)
+
+
+@_timed
+def get_blocking_states() -> dict[tuple[str, str], t.BlockingState]:
+    # the latest state of every (domain, isp) pair in blocking_history
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            """
+            SELECT history.domain, history.isp, history.state
+            FROM blocking_history history
+            JOIN (
+                SELECT MAX(seq) AS seq FROM blocking_history GROUP BY domain, isp
+            ) latest ON latest.seq = history.seq
+        """)
+        return {(domain, isp): t.BlockingState[state] for domain, isp, state in cursor.fetchall()}
+
+
+@_timed
+def get_blocking_history(domain: str) -> list[t.BlockingStateChange]:
+    # state changes of all ISPs for one domain, oldest first
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            """
+            SELECT seq, domain, isp, state, changed_on
+            FROM blocking_history
+            WHERE domain = %s
+            ORDER BY seq
+        """, (domain,))
+        results = cursor.fetchall()
+    return [
+        t.BlockingStateChange(seq, domain, isp, t.BlockingState[state], changed_on)
+        for seq, domain, isp, state, changed_on in results
+    ]
+
+
+@_timed
+def add_blocking_state_changes(changes: list[t.BlockingStateChange]):
+    if not changes:
+        return
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.executemany(
+            """
+                    INSERT INTO blocking_history (domain, isp, state, changed_on)
+                    VALUES (%s, %s, %s, %s)
                     """,
-            (domain,)
+            [(change.domain, change.isp, change.state.name, change.changed_on) for change in changes]
         )
         connection.commit()
 
 
+@_timed
 def get_ignorelist() -> list[str]:
     with get_connection() as connection:
         cursor = connection.cursor()
@@ -267,6 +521,7 @@ def get_ignorelist() -> list[str]:
         return [domain for domain, in cursor.fetchall()]
 
 
+@_timed
 def add_potentially_blocked_domain(blocked_domain: t.BlockedDomain) -> bool:
     # returns True if the domain was added, False if it already exists
     with get_connection() as connection:
@@ -280,5 +535,60 @@ def add_potentially_blocked_domain(blocked_domain: t.BlockedDomain) -> bool:
             (blocked_domain.domain,)
         )
         connection.commit()
-        print(cursor.rowcount)
         return cursor.rowcount > 0  # if the row was added, rowcount will be 1
+
+
+@_timed
+def get_potentially_blocked_domains() -> list[str]:
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT domain FROM potentially_blocked")
+        return [domain for domain, in cursor.fetchall()]
+
+
+@_timed
+def add_potentially_blocked_domains(domains: list[str]) -> list[str]:
+    # returns the domains that weren't in the table yet. Every row is inserted on its own inside one transaction,
+    # so INSERT IGNORE's rowcount tells exactly which worker added a domain, even if several flush it at once
+    new_domains = []
+    if not domains:
+        return new_domains
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        for domain in dict.fromkeys(domains):
+            cursor.execute(
+                """
+                    INSERT IGNORE INTO potentially_blocked (domain)
+                    VALUES (%s)
+                    """,
+                (domain,)
+            )
+            if cursor.rowcount > 0:
+                new_domains.append(domain)
+        connection.commit()
+        return new_domains
+
+
+# Async variants for the background event loop. The blocking mysql-connector calls run in a small thread pool,
+# so they don't stall the probes running on the loop.
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="database")
+
+
+async def _run_async(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_executor, partial(func, *args))
+
+
+async def get_blocked_domains_async() -> list[t.BlockedDomain]:
+    return await _run_async(get_blocked_domains)
+
+
+async def remove_blocked_domains_async(domains: list[str]):
+    await _run_async(remove_blocked_domains, domains)
+
+
+async def get_blocking_states_async() -> dict[tuple[str, str], t.BlockingState]:
+    return await _run_async(get_blocking_states)
+
+
+async def add_blocking_state_changes_async(changes: list[t.BlockingStateChange]):
+    await _run_async(add_blocking_state_changes, changes)
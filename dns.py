@@ -2,67 +2,195 @@ import asyncio
 import traceback
 from asyncio import CancelledError
 
-import async_dns.request
-
+import circuit_breaker
 import data_types as t
+import dns_wire
 from async_dns import DNSMessage, REQUEST, Record
 from async_dns.core import types
+import metrics
 import notifications
+import probe_engine
+import resolver_stats
 
-__all__ = ["is_cuii_blocked_single", "run_full_check"]
+__all__ = ["is_cuii_blocked_single", "probe", "run_full_check"]
 
+# responses that don't tell us anything about the domain
+NO_ANSWER = (t.SingleProbeResponseType.ERROR, t.SingleProbeResponseType.TIMEOUT, t.SingleProbeResponseType.PENDING,
+             t.SingleProbeResponseType.SKIPPED)
 
-async def is_cuii_blocked_single(domain: str, resolver: t.DNSResolver) -> t.SingleProbeResponse:
-    resp: t.SingleProbeResponseType = t.SingleProbeResponseType.NOT_BLOCKED  # default to not blocked
-    start_time = asyncio.get_event_loop().time()
-    dispatcher = async_dns.request.udp.Dispatcher(resolver.address.ip_type)
-    try:
-        req = DNSMessage(qr=REQUEST)
-        req.qd = [Record(REQUEST, domain, types.SOA)]
-        data = await dispatcher.send(req, resolver.address, 3.0)
-        res = DNSMessage.parse(data)
 
-        end_time = asyncio.get_event_loop().time()
-        duration = int((end_time - start_time) * 1000)
+async def is_cuii_blocked_single(domain: str, resolver: t.DNSResolver,
+                                 semaphore: asyncio.Semaphore | None = None) -> t.SingleProbeResponse:
+    response, duration = await probe(domain, resolver, semaphore)
+    return t.SingleProbeResponse(response, duration, domain, resolver)
 
-        if resolver.blocking_type == t.BlockingType.SERVFAIL:
-            if res.r == 2:
-                # SERVFAIL
-                resp = t.SingleProbeResponseType.BLOCKED
 
-        elif resolver.blocking_type == t.BlockingType.NO_SOA:
-            if res.r == 3 and len(res.ns) == 0:
-                resp = t.SingleProbeResponseType.BLOCKED
+async def probe(domain: str, resolver: t.DNSResolver,
+                semaphore: asyncio.Semaphore | None = None) -> tuple[t.SingleProbeResponseType, int]:
+    # same as is_cuii_blocked_single, but only the outcome and the duration in ms, without a response object
+    if semaphore is not None:
+        # limit the number of in-flight probes to this resolver, the timeout only starts once we got a slot
+        async with semaphore:
+            return await probe(domain, resolver)
+
+    response, duration = await _probe_single(domain, resolver)
+    metrics.PROBE_LATENCY.labels(resolver.name, response.name).observe(duration / 1000)
+    return response, duration
 
-        elif resolver.blocking_type == t.BlockingType.CNAME:
-            # check if the response contains a CNAME record and if it points to "notice.cuii.info"
-            for record in res.an:
-                if record.qtype == types.CNAME and record.data and record.data.data == "notice.cuii.info":
-                    resp = t.SingleProbeResponseType.BLOCKED
 
-        return t.SingleProbeResponse(resp, duration, domain, resolver)
+async def _probe_single(domain: str, resolver: t.DNSResolver) -> tuple[t.SingleProbeResponseType, int]:
+    start_time = asyncio.get_event_loop().time()
+    # adaptive timeout and hedged retry, based on the resolver's recent latency
+    timeout = resolver_stats.timeout_for(resolver.address)
+    try:
+        # packets are built and classified on the wire format, async_dns only handles the unusual cases
+        query = dns_wire.build_query(domain)
+        if query is None:
+            req = DNSMessage(qr=REQUEST)
+            req.qd = [Record(REQUEST, domain, types.SOA)]
+            query = req.pack()
+        data = await probe_engine.get_engine().send(
+            query, resolver.address, timeout, resolver_stats.hedge_delay_for(resolver.address)
+        )
+        resp = dns_wire.classify(data, resolver.blocking_type)
+        if resp is None:
+            resp = _classify_parsed(DNSMessage.parse(data), resolver.blocking_type)
 
-    except (CancelledError, asyncio.TimeoutError):
-        resp = t.SingleProbeResponseType.TIMEOUT
-        return t.SingleProbeResponse(resp, 3000, domain, resolver)
+        end_time = asyncio.get_event_loop().time()
+        duration = int((end_time - start_time) * 1000)
+        resolver_stats.record(resolver.address, duration, True)
+        circuit_breaker.record(resolver.address, True)
+
+        return resp, duration
+
+    except asyncio.TimeoutError:
+        resolver_stats.record(resolver.address, int(timeout * 1000), False)
+        circuit_breaker.record(resolver.address, False)
+        return t.SingleProbeResponseType.TIMEOUT, int(timeout * 1000)
+    except CancelledError:
+        # stopped by an early decision or a client that went away, that says nothing about the resolver,
+        # so it is neither reported as a timeout nor recorded
+        raise
+    except ConnectionError as e:
+        # tcp / tls / https resolver not reachable, or backing off before reconnecting
+        print(f"Could not reach resolver {resolver}: {e}")
+        resolver_stats.record(resolver.address, int(timeout * 1000), False)
+        circuit_breaker.record(resolver.address, False)
+        duration = int((asyncio.get_event_loop().time() - start_time) * 1000)
+        return t.SingleProbeResponseType.TIMEOUT, duration
     except BaseException as e:
         notifications.error(f"Ein DNS Resolver hat einen Fehler {resolver}: {e}")
         print(f"Error with resolver {resolver}: {e}")
         traceback.print_exc()
-    finally:
-        try:
-            dispatcher.destroy()
-        except Exception as e:
-            print(f"Error destroying dispatcher: {e}")
+        circuit_breaker.record(resolver.address, False)
+        duration = int((asyncio.get_event_loop().time() - start_time) * 1000)
+        return t.SingleProbeResponseType.ERROR, duration
 
 
-async def run_full_check(domain: str, dns_resolvers: list[t.DNSResolver]) -> t.FullProbeResponse:
+def _classify_parsed(res: DNSMessage, blocking_type: t.BlockingType | None) -> t.SingleProbeResponseType:
+    resp: t.SingleProbeResponseType = t.SingleProbeResponseType.NOT_BLOCKED  # default to not blocked
+    if blocking_type == t.BlockingType.SERVFAIL:
+        if res.r == 2:
+            # SERVFAIL
+            resp = t.SingleProbeResponseType.BLOCKED
+
+    elif blocking_type == t.BlockingType.NO_SOA:
+        if res.r == 3 and len(res.ns) == 0:
+            resp = t.SingleProbeResponseType.BLOCKED
+
+    elif blocking_type == t.BlockingType.CNAME:
+        # check if the response contains a CNAME record and if it points to "notice.cuii.info"
+        for record in res.an:
+            if record.qtype == types.CNAME and record.data and record.data.data == "notice.cuii.info":
+                resp = t.SingleProbeResponseType.BLOCKED
+    return resp
+
+
+async def run_full_check(domain: str, dns_resolvers: list[t.DNSResolver],
+                         resolver_limits: dict[t.Address, asyncio.Semaphore] | None = None,
+                         quorum: int | None = None, deadline: float | None = None,
+                         skip_open_circuits: bool = False) -> t.FullProbeResponse:
     # Run the check on all resolvers concurrently
-    tasks = [is_cuii_blocked_single(domain, resolver) for resolver in dns_resolvers]
-    results: list[t.SingleProbeResponse] = await asyncio.gather(*tasks)  # noqa
-    # Analyze the results
-    final_result = analyze_results(results)
-    return t.FullProbeResponse(results, final_result)
+    # resolver_limits optionally maps a resolver address to a semaphore bounding its in-flight probes
+    # skip_open_circuits reports resolvers with an open circuit breaker as SKIPPED instead of probing them
+    with metrics.timed(metrics.FULL_CHECK_LATENCY):
+        return await _run_full_check(domain, dns_resolvers, resolver_limits, quorum, deadline, skip_open_circuits)
+
+
+async def _run_full_check(domain: str, dns_resolvers: list[t.DNSResolver],
+                          resolver_limits: dict[t.Address, asyncio.Semaphore] | None,
+                          quorum: int | None, deadline: float | None,
+                          skip_open_circuits: bool) -> t.FullProbeResponse:
+    tasks = [
+        _skipped(domain, resolver) if skip_open_circuits and not circuit_breaker.allow(resolver.address) else
+        is_cuii_blocked_single(domain, resolver, resolver_limits.get(resolver.address) if resolver_limits else None)
+        for resolver in dns_resolvers
+    ]
+    if quorum is None and deadline is None:
+        results: list[t.SingleProbeResponse] = await asyncio.gather(*tasks)  # noqa
+        # Analyze the results
+        final_result = analyze_results(results)
+        return t.FullProbeResponse(results, final_result)
+
+    # Early decision mode: return as soon as the outcome is settled or the deadline (in seconds) is reached,
+    # resolvers that haven't answered by then are reported as PENDING
+    loop = asyncio.get_event_loop()
+    end_time = loop.time() + deadline if deadline is not None else None
+    indices = {asyncio.ensure_future(task): i for i, task in enumerate(tasks)}
+    answered: dict[int, t.SingleProbeResponse] = {}
+    pending = set(indices)
+    while pending:
+        timeout = max(0.0, end_time - loop.time()) if end_time is not None else None
+        done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if not done:  # deadline reached
+            break
+        for task in done:
+            answered[indices[task]] = task.result()
+        if pending and is_decided(list(answered.values()), len(pending), quorum):
+            break
+    for task in pending:
+        task.cancel()
+
+    results = [
+        answered.get(i) or t.SingleProbeResponse(t.SingleProbeResponseType.PENDING, 0, domain, resolver)
+        for i, resolver in enumerate(dns_resolvers)
+    ]
+    return t.FullProbeResponse(results, analyze_results(results), decided_early=len(pending) > 0)
+
+
+async def _skipped(domain: str, resolver: t.DNSResolver) -> t.SingleProbeResponse:
+    return t.SingleProbeResponse(t.SingleProbeResponseType.SKIPPED, 0, domain, resolver)
+
+
+def category(any_blocked: bool, any_not_blocked: bool) -> t.FullProbeResponseType:
+    # same rules as analyze_results, reduced to which answers have been seen
+    if not any_blocked and not any_not_blocked:
+        return t.FullProbeResponseType.ERROR
+    if not any_blocked:
+        return t.FullProbeResponseType.NOT_BLOCKED
+    if not any_not_blocked:
+        return t.FullProbeResponseType.BLOCKED
+    return t.FullProbeResponseType.PARTIALLY_BLOCKED
+
+
+def is_decided(results: list[t.SingleProbeResponse], pending: int, quorum: int | None) -> bool:
+    answers = {result.response for result in results if result.response not in NO_ANSWER}
+    answer_count = sum(1 for result in results if result.response not in NO_ANSWER)
+    # enough resolvers agree that the domain is blocked, e.g. several ISPs pointing to notice.cuii.info. A late
+    # NOT_BLOCKED could only make it PARTIALLY_BLOCKED. Agreeing NOT_BLOCKED answers never stop early, a single
+    # late BLOCKED answer would mean the domain is blocked after all
+    if quorum is not None and answer_count >= quorum and answers == {t.SingleProbeResponseType.BLOCKED}:
+        return True
+
+    # otherwise only stop if no combination of the outstanding answers can change the category
+    any_blocked = t.SingleProbeResponseType.BLOCKED in answers
+    any_not_blocked = t.SingleProbeResponseType.NOT_BLOCKED in answers
+    additions = [(False, False), (True, False), (False, True)]
+    if pending >= 2:
+        additions.append((True, True))
+    outcomes = {category(any_blocked or add_blocked, any_not_blocked or add_not_blocked)
+                for add_blocked, add_not_blocked in additions}
+    return len(outcomes) == 1
 
 
 def analyze_results(results: list[t.SingleProbeResponse]):
@@ -75,15 +203,11 @@ def analyze_results(results: list[t.SingleProbeResponse]):
     #     else:
     #         # Not a blocking resolver
     #         non_blocking_results.append(result)
-    all_errors = all(
-        result.response in (t.SingleProbeResponseType.ERROR, t.SingleProbeResponseType.TIMEOUT)
-        for result in results
-    )
+    all_errors = all(result.response in NO_ANSWER for result in results)
     if all_errors:
         return t.FullProbeResponseType.ERROR
 
-    no_errors = [result for result in results if result.response
-                 not in (t.SingleProbeResponseType.ERROR, t.SingleProbeResponseType.TIMEOUT)]
+    no_errors = [result for result in results if result.response not in NO_ANSWER]
 
 
     # all not blocked
@@ -109,7 +233,14 @@ def tes(domain):
         "test",
         t.BlockingType.CNAME
     )
-    print(asyncio.run(is_cuii_blocked_single(domain, resolver)).response)
+
+    async def probe():
+        try:
+            return await is_cuii_blocked_single(domain, resolver)
+        finally:
+            probe_engine.close_engine()
+
+    print(asyncio.run(probe()).response)
 
 
 if __name__ == '__main__':
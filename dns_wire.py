@@ -0,0 +1,103 @@
+import struct
+
+import data_types as t
+
+__all__ = ["build_query", "question", "classify"]
+
+# Probes only need the rcode, the NS count and whether an answer is a CNAME to notice.cuii.info, so the hot path
+# works on the raw packets instead of building and parsing DNSMessage objects. Anything unusual returns None and
+# the caller falls back to async_dns.
+
+# id (filled in by the probe engine), flags RD|RA, 1 question, no other records. Same bytes as DNSMessage(qr=REQUEST)
+_QUERY_HEADER = bytes.fromhex("000001800001000000000000")
+_QUERY_QUESTION = b"\x00\x00\x06\x00\x01"  # root label, type SOA, class IN
+
+_HEADER = struct.Struct("!HHHHHH")
+_RECORD = struct.Struct("!HHIH")  # type, class, ttl, rdlength after a record's name
+_CNAME = 5
+_NOTICE = b"notice.cuii.info"
+
+
+def build_query(domain: str) -> bytes | None:
+    # None if the domain can't be encoded as plain labels
+    try:
+        labels = domain.encode("ascii").split(b".")
+    except UnicodeEncodeError:
+        return None
+    if any(not 0 < len(label) < 64 for label in labels):
+        return None
+    return b"".join((_QUERY_HEADER, *(bytes((len(label),)) + label for label in labels), _QUERY_QUESTION))
+
+
+def _skip_name(packet: memoryview, offset: int) -> int:
+    while True:
+        length = packet[offset]
+        if length == 0:
+            return offset + 1
+        if length >= 0xC0:  # compression pointer, always ends the name
+            return offset + 2
+        if length >= 0x40:
+            raise ValueError("Unsupported label type")
+        offset += length + 1
+
+
+def _read_name(packet: memoryview, offset: int) -> bytes:
+    labels = []
+    for _ in range(128):  # guards against pointer loops
+        length = packet[offset]
+        if length == 0:
+            return b".".join(labels)
+        if length >= 0xC0:
+            offset = (length - 0xC0) << 8 | packet[offset + 1]
+            continue
+        if length >= 0x40:
+            raise ValueError("Unsupported label type")
+        labels.append(packet[offset + 1:offset + 1 + length].tobytes())
+        offset += length + 1
+    raise ValueError("Pointer loop")
+
+
+def question(packet: bytes) -> bytes | None:
+    # name, type and class of the first question, the name lowercased as resolvers may change its case (0x20
+    # encoding). None if there is no question or it is malformed
+    try:
+        if _HEADER.unpack_from(packet)[2] == 0:
+            return None
+        end = _skip_name(memoryview(packet), 12)
+    except (IndexError, ValueError, struct.error):
+        return None
+    if end + 4 > len(packet):
+        return None
+    return packet[12:end].lower() + packet[end:end + 4]
+
+
+def classify(data: bytes, blocking_type: t.BlockingType | None) -> t.SingleProbeResponseType | None:
+    # same rules as dns._classify_parsed. None: truncated, not a response to a single question, or malformed
+    try:
+        _, flags, qdcount, ancount, nscount, _ = _HEADER.unpack_from(data)
+        if not flags & 0x8000 or flags & 0x0200 or qdcount != 1:  # QR not set, or TC set
+            return None
+        rcode = flags & 0x000F
+
+        if blocking_type == t.BlockingType.SERVFAIL:
+            blocked = rcode == 2
+        elif blocking_type == t.BlockingType.NO_SOA:
+            blocked = rcode == 3 and nscount == 0
+        elif blocking_type == t.BlockingType.CNAME:
+            packet = memoryview(data)
+            offset = _skip_name(packet, 12) + 4  # question name, type and class
+            blocked = False
+            for _ in range(ancount):
+                offset = _skip_name(packet, offset)
+                record_type, _, _, rdlength = _RECORD.unpack_from(packet, offset)
+                offset += _RECORD.size
+                if offset + rdlength > len(packet):
+                    return None
+                if record_type == _CNAME and _read_name(packet, offset) == _NOTICE:
+                    blocked = True
+                offset += rdlength
+        else:
+            blocked = False
+    except (IndexError, ValueError, struct.error):
+        return None
+    return t.SingleProbeResponseType.BLOCKED if blocked else t.SingleProbeResponseType.NOT_BLOCKED
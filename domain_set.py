@@ -0,0 +1,44 @@
+from typing import Iterable, Iterator
+
+__all__ = ["DomainSet"]
+
+_END = ""  # marks a listed domain in the suffix index, labels are never empty
+
+
+class DomainSet:
+    # Hashed set of domains plus an index of their reversed labels (com -> example -> www),
+    # so exact and parent-domain lookups cost O(number of labels) no matter how many domains are listed.
+    def __init__(self, domains: Iterable[str]):
+        self._domains = set()
+        self._index: dict = {}
+        for domain in domains:
+            domain = domain.strip(" .").lower()
+            if not domain:
+                continue
+            self._domains.add(domain)
+            node = self._index
+            for label in reversed(domain.split(".")):
+                node = node.setdefault(label, {})
+            node[_END] = True
+
+    def __contains__(self, domain: str) -> bool:
+        return domain in self._domains
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._domains)
+
+    def __len__(self) -> int:
+        return len(self._domains)
+
+    def matches(self, domain: str) -> bool:
+        # True if the domain or one of its parent domains is listed
+        if domain in self._domains:
+            return True
+        node = self._index
+        for label in reversed(domain.split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+            if _END in node:
+                return True
+        return False
@@ -0,0 +1,6 @@
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    # drop the live gauges of dead workers from /metrics
+    multiprocess.mark_process_dead(worker.pid)
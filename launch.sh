@@ -1 +1,3 @@
-python3 -m gunicorn -w 4 -b 127.0.0.1:5099 app:app
\ No newline at end of file
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/cuiiliste_metrics}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+python3 -m gunicorn -c gunicorn.conf.py -w 4 -k gthread --threads 32 -b 127.0.0.1:5099 app:app
\ No newline at end of file
@@ -0,0 +1,85 @@
+import os
+import threading
+import time
+
+import circuit_breaker
+import data_types as t
+import database
+from domain_set import DomainSet
+import probe_engine
+import resolver_stats
+
+__all__ = ["load", "start_reloading", "get_resolvers", "get_ignorelist"]
+
+# The resolver set and the ignorelist, refreshed from the database without restarting the workers.
+# A cheap fingerprint query runs every CONFIG_RELOAD_INTERVAL seconds, the tables are only reloaded when it changed.
+# The new lists are swapped in as a whole, readers always see either the old or the new list.
+_resolvers: list[t.DNSResolver] = []
+_ignorelist = DomainSet([])
+_version: tuple | None = None
+_lock = threading.Lock()
+
+
+def get_resolvers() -> list[t.DNSResolver]:
+    return _resolvers
+
+
+def get_ignorelist() -> DomainSet:
+    return _ignorelist
+
+
+def _describe(resolver: t.DNSResolver) -> tuple:
+    return resolver.name, resolver.is_blocking, resolver.isp, resolver.blocking_type
+
+
+def _swap_resolvers(new_resolvers: list[t.DNSResolver]):
+    global _resolvers
+    old = {resolver.address: resolver for resolver in _resolvers}
+    new = {resolver.address: resolver for resolver in new_resolvers}
+    added = [str(resolver) for address, resolver in new.items() if address not in old]
+    removed = [str(resolver) for address, resolver in old.items() if address not in new]
+    changed = [str(resolver) for address, resolver in new.items()
+               if address in old and _describe(old[address]) != _describe(resolver)]
+    _resolvers = new_resolvers
+    # only forget state of resolvers that are gone, changed ones keep their history (same server)
+    for address in old.keys() - new.keys():
+        probe_engine.forget(address)
+        resolver_stats.forget(address)
+        circuit_breaker.forget(address)
+    if old and (added or removed or changed):
+        print(f"Reloaded DNS resolvers, added: {added}, removed: {removed}, changed: {changed}")
+
+
+def _swap_ignorelist(new_ignorelist: list[str]):
+    global _ignorelist
+    added = set(new_ignorelist) - set(_ignorelist)
+    removed = set(_ignorelist) - set(new_ignorelist)
+    if _ignorelist and (added or removed):
+        print(f"Reloaded ignorelist, added: {sorted(added)}, removed: {sorted(removed)}")
+    _ignorelist = DomainSet(new_ignorelist)
+
+
+def load():
+    global _version
+    with _lock:
+        version = database.get_config_version()
+        if version == _version:
+            return
+        resolvers_version, ignorelist_version = version
+        if _version is None or _version[0] != resolvers_version:
+            _swap_resolvers(database.get_dns_resolvers())
+        if _version is None or _version[1] != ignorelist_version:
+            _swap_ignorelist(database.get_ignorelist())
+        _version = version
+
+
+def start_reloading():
+    def run():
+        while True:
+            time.sleep(float(os.getenv("CONFIG_RELOAD_INTERVAL", "60")))
+            try:
+                load()
+            except Exception as e:
+                print(f"Error reloading resolvers and ignorelist: {e}")
+
+    threading.Thread(target=run, name="config-reload", daemon=True).start()
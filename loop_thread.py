@@ -0,0 +1,31 @@
+import asyncio
+import concurrent.futures
+import threading
+from typing import Any, Coroutine
+
+__all__ = ["get_loop", "submit", "run"]
+
+# One long-lived event loop per worker process. Request threads submit their probes to it, so many checks
+# can be in flight at once and they all share the same probe sockets.
+_loop: asyncio.AbstractEventLoop | None = None
+_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is None:
+        with _lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="probe-loop", daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+def submit(coro: Coroutine) -> concurrent.futures.Future:
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run(coro: Coroutine, timeout: float | None = None) -> Any:
+    # blocks the calling (request) thread only, not the loop
+    return submit(coro).result(timeout)
@@ -0,0 +1,67 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, \
+    generate_latest, multiprocess
+
+__all__ = [
+    "PROBE_LATENCY",
+    "FULL_CHECK_LATENCY",
+    "DB_QUERY_LATENCY",
+    "DB_POOL_WAIT",
+    "WEBHOOK_LATENCY",
+    "WEBHOOK_FAILURES",
+    "SWEEP_DURATION",
+    "SWEEP_LAG",
+    "timed",
+    "render"
+]
+
+# With PROMETHEUS_MULTIPROC_DIR set (see launch.sh) every gunicorn worker writes its samples to that directory
+# and /metrics aggregates all of them, no matter which worker serves the scrape.
+
+PROBE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0)
+
+PROBE_LATENCY = Histogram(
+    "cuii_probe_seconds", "Latency of single DNS probes", ["resolver", "outcome"], buckets=PROBE_BUCKETS
+)
+FULL_CHECK_LATENCY = Histogram(
+    "cuii_full_check_seconds", "End-to-end latency of run_full_check", buckets=PROBE_BUCKETS
+)
+DB_QUERY_LATENCY = Histogram(
+    "cuii_db_query_seconds", "Latency of database functions, including the pool wait", ["function"]
+)
+DB_POOL_WAIT = Histogram(
+    "cuii_db_pool_wait_seconds", "Time spent getting a connection from the pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+)
+WEBHOOK_LATENCY = Histogram("cuii_webhook_seconds", "Latency of webhook POSTs")
+WEBHOOK_FAILURES = Counter("cuii_webhook_failures_total", "Webhook POSTs that failed or were rejected")
+SWEEP_DURATION = Histogram(
+    "cuii_sweep_seconds", "Duration of background revalidation batches",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+)
+SWEEP_LAG = Gauge(
+    "cuii_sweep_lag_seconds", "How far the most overdue blocked domain is behind its revalidation schedule",
+    multiprocess_mode="livemax"
+)
+
+
+@contextmanager
+def timed(histogram) -> Iterator[None]:
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start_time)
+
+
+def render() -> tuple[bytes, str]:
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -1,39 +1,70 @@
 import asyncio
 import hashlib
+import json
 import os
+import queue
 import re
 from datetime import datetime
+from typing import Iterator
 
-import background_tasks
+import blocklist_snapshot
+import circuit_breaker
 import data_types as t
 import database
 import dns
+from domain_set import DomainSet
 import notifications
+import loop_thread
+import potentially_blocked
+import request_timing
+import result_cache
+import shared_state
 
 
-def test_domain(domain: str, resolvers: list[t.DNSResolver], domain_ignorelist: list[str]) \
-        -> dict[str, str | list[dict[str, str | int]]]:
+def normalize_domain(domain: str) -> str | None:
+    # returns None if the domain is invalid
     domain = re.sub(r"^(http(s)?://)?", "", domain.strip(" \t\n\r\v\f.").lower())  # normalize domain
     if len(domain) == 0 or not re.match(r"^[a-z0-9.-]+$", domain) or len(domain) > 255:
-        return {"error": "Invalid domain"}
+        return None
+    return domain
+
+
+async def _probe(domain: str, resolvers: list[t.DNSResolver]) -> tuple[t.FullProbeResponse, float]:
+    # runs on the worker's shared loop, popular domains are answered from the result cache
+    # EARLY_DECISION_QUORUM / EARLY_DECISION_DEADLINE enable returning before every resolver answered
+    # resolvers known to be down are skipped instead of waiting for their timeout
+    quorum = os.getenv("EARLY_DECISION_QUORUM")
+    deadline = os.getenv("EARLY_DECISION_DEADLINE")
+    circuit_breaker.apply_shared_health(resolvers)
+    return await result_cache.get_cache().get(domain, lambda: dns.run_full_check(
+        domain,
+        resolvers,
+        quorum=int(quorum) if quorum else None,
+        deadline=float(deadline) if deadline else None,
+        skip_open_circuits=True
+    ))
 
-    results = asyncio.run(dns.run_full_check(domain, resolvers))
 
-    if results.final_result in (t.FullProbeResponseType.BLOCKED, t.FullProbeResponseType.PARTIALLY_BLOCKED):
+def _handle_results(domain: str, results: t.FullProbeResponse, age: float, domain_ignorelist: DomainSet) \
+        -> dict[str, str | float | list[dict[str, str | int]]]:
+    final_result = results.final_result  # don't modify results, the object is shared through the cache
+
+    if final_result in (t.FullProbeResponseType.BLOCKED, t.FullProbeResponseType.PARTIALLY_BLOCKED):
         # database.add_blocking_instances([
         #         t.BlockingInstance(domain, result.resolver.isp, datetime.now())
         #         for result in results.responses if result.response == t.SingleProbeResponseType.BLOCKED
         # ])
-        if domain in domain_ignorelist:
-            results.final_result = t.FullProbeResponseType.NON_CUII_BLOCK
+        if domain_ignorelist.matches(domain):  # the domain or one of its parents is ignored
+            final_result = t.FullProbeResponseType.NON_CUII_BLOCK
         else:
-            is_new_block = database.add_potentially_blocked_domain(t.BlockedDomain(domain, None, datetime.now(), None))
-            if is_new_block:
-                notifications.domain_potentially_blocked(domain)
+            # buffered, the insert and the notification for new domains happen in the background
+            potentially_blocked.add(domain)
 
     return {
         "domain": domain,
-        "final_result": results.final_result.name,
+        "final_result": final_result.name,
+        "age": round(age, 1),  # seconds since the domain was actually probed
+        "decided_early": results.decided_early,
         "responses": [
             {
                 "resolver": result.resolver.name,
@@ -47,32 +78,164 @@ def test_domain(domain: str, resolvers: list[t.DNSResolver], domain_ignorelist:
     }
 
 
+def _skip_ignored(domain: str, domain_ignorelist: DomainSet) -> bool:
+    # with IGNORELIST_SKIP_PROBE ignored domains aren't probed at all
+    return bool(os.getenv("IGNORELIST_SKIP_PROBE")) and domain_ignorelist.matches(domain)
+
+
+def _ignored(domain: str) -> dict[str, str | float | bool | list]:
+    return {
+        "domain": domain,
+        "final_result": t.FullProbeResponseType.IGNORED.name,
+        "age": 0.0,
+        "decided_early": False,
+        "responses": []
+    }
+
+
+def test_domain(domain: str, resolvers: list[t.DNSResolver], domain_ignorelist: DomainSet) \
+        -> dict[str, str | float | list[dict[str, str | int]]]:
+    with request_timing.phase("normalize"):
+        domain = normalize_domain(domain)
+    if domain is None:
+        return {"error": "Invalid domain"}
+    if _skip_ignored(domain, domain_ignorelist):
+        return _ignored(domain)
+
+    with request_timing.phase("probe"):  # waits for the slowest resolver (or the cache)
+        results, age = loop_thread.run(_probe(domain, resolvers))
+    return _handle_results(domain, results, age, domain_ignorelist)
+
+
+def test_domains(domains: list, resolvers: list[t.DNSResolver], domain_ignorelist: DomainSet) -> Iterator[str]:
+    # Checks many domains concurrently and yields one NDJSON line per domain as soon as its check finishes
+    max_domains = int(os.getenv("BULK_MAX_DOMAINS", "1000"))
+    if len(domains) > max_domains:
+        yield json.dumps({"error": f"Too many domains, at most {max_domains} per request"}) + "\n"
+        return
+
+    valid: dict[str, None] = {}  # ordered set, the same domain is only checked once
+    for raw_domain in domains:
+        domain = normalize_domain(raw_domain) if isinstance(raw_domain, str) else None
+        if domain is None:
+            yield json.dumps({"domain": raw_domain, "error": "Invalid domain"}) + "\n"
+        elif _skip_ignored(domain, domain_ignorelist):
+            yield json.dumps(_ignored(domain)) + "\n"
+        else:
+            valid[domain] = None
+
+    finished: queue.Queue[tuple[str, tuple[t.FullProbeResponse, float] | None]] = queue.Queue()
+
+    async def probe_all():
+        limit = asyncio.Semaphore(int(os.getenv("BULK_CONCURRENCY", "50")))
+
+        async def probe_one(domain_: str):
+            try:
+                async with limit:
+                    finished.put((domain_, await _probe(domain_, resolvers)))
+            except Exception as e:
+                print(f"Error while bulk testing {domain_}: {e}")
+                finished.put((domain_, None))
+
+        await asyncio.gather(*(probe_one(domain_) for domain_ in valid))
+
+    future = loop_thread.submit(probe_all())
+    remaining = dict(valid)
+    try:
+        while remaining:
+            try:
+                domain, result = finished.get(timeout=1.0)
+            except queue.Empty:
+                if not future.done() or not finished.empty():
+                    continue
+                # probe_all failed or was cancelled before every domain was reported, don't wait for them
+                print(f"Bulk test stopped early: {'cancelled' if future.cancelled() else repr(future.exception())}")
+                for domain in remaining:
+                    yield json.dumps({"domain": domain, "error": "Check failed"}) + "\n"
+                return
+            remaining.pop(domain, None)
+            if result is None:
+                yield json.dumps({"domain": domain, "error": "Check failed"}) + "\n"
+                continue
+            yield json.dumps(_handle_results(domain, *result, domain_ignorelist)) + "\n"
+    finally:
+        future.cancel()  # the client went away, stop probing
+
+
 def get_resolvers():
-    resolver_healths = background_tasks.get_resolver_health()
-    return [
+    # published by whichever worker runs the background tasks
+    return shared_state.read("resolvers", [])
+
+
+def get_blocked_domains(if_none_match, accepts_gzip: bool, export_format: str = "json") \
+        -> tuple[bytes, int, dict[str, str]] | tuple[dict[str, str], int]:
+    # served from the in-memory snapshot, conditional requests get a 304 without a body
+    snapshot = blocklist_snapshot.get_snapshot()
+    export = snapshot.exports.get(export_format)
+    if export is None:
+        return {"error": f"Unknown format, use one of {', '.join(snapshot.exports)}"}, 404
+    # the gzip body is a different representation and gets its own ETag
+    etag = f"{export.etag}-gz" if accepts_gzip else export.etag
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+        "Content-Type": export.content_type,
+        "X-Blocklist-Seq": str(snapshot.change_seq)  # mirrors continue with /blocked_domains/changes?since=
+    }
+    if if_none_match.contains(etag):
+        return b"", 304, headers
+    if accepts_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return export.gzip_body, 200, headers
+    return export.body, 200, headers
+
+
+def get_blocklist_changes(since: str | None, limit: str | None):
+    try:
+        since = int(since or 0)
+        limit = max(1, min(int(limit or 1000), 10000))
+    except ValueError:
+        return {"error": "Invalid cursor"}
+    changes = database.get_blocklist_changes(since, limit + 1)  # one extra row tells us whether there is more
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    return {
+        "changes": [
             {
-                "resolver": resolver.resolver.name,
-                "isp": resolver.resolver.isp,
-                "protocol": resolver.resolver.address.protocol,
-                "health": resolver.health.name,
-                "ping": resolver.ping,
-                "obeys_cuii": resolver.resolver.is_blocking
+                "seq": change.seq,
+                "domain": change.domain,
+                "action": change.action.name,
+                "site": change.site_reference,
+                "changed_on": change.changed_on.isoformat() if change.changed_on else None
             }
-            for resolver in resolver_healths
-    ]
-
-
-def get_blocked_domains():
-    blocked_domains = database.get_blocked_domains()
-    return [
-        {
-            "domain": blocked_domain.domain,
-            # "added_by": blocked_domain.added_by, - removed for now
-            "first_blocked_on": blocked_domain.first_blocked_on.date().isoformat(),
-            "site": blocked_domain.site.name if blocked_domain.site else None,
-        }
-        for blocked_domain in blocked_domains
-    ]
+            for change in changes
+        ],
+        "next": changes[-1].seq if changes else since,
+        "has_more": has_more
+    }
+
+
+def get_blocking_history(domain: str | None):
+    domain = normalize_domain(domain or "")
+    if domain is None:
+        return {"error": "Invalid domain"}
+    history = database.get_blocking_history(domain)
+    current = {}
+    for change in history:  # oldest first, so the last change per ISP wins
+        current[change.isp] = change.state.name
+    return {
+        "domain": domain,
+        "isps": current,
+        "history": [
+            {
+                "isp": change.isp,
+                "state": change.state.name,
+                "changed_on": change.changed_on.isoformat() if change.changed_on else None
+            }
+            for change in history
+        ]
+    }
 
 
 def add_domain(domain, key):
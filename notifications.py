@@ -1,12 +1,138 @@
+import atexit
 import os
+import queue
+import threading
+import time
+
 import requests
 
+import metrics
+
+# Webhooks are only queued by the callers, a background thread sends them. Messages arriving within
+# WEBHOOK_BATCH_WINDOW seconds are merged into one message with up to 10 embeds (Discord's limit).
+MAX_EMBEDS = 10
+
+_queue: queue.Queue[dict] | None = None
+_in_flight: list[dict] | None = None  # messages the sender thread took off the queue and hasn't sent yet
+_session = requests.Session()  # keeps the connection to the webhook host alive
+_start_lock = threading.Lock()
+
 
 def send_webhook(data: dict):
-    webhook_url = os.getenv("WEBHOOK_URL")
-    if not webhook_url:
+    global _queue
+    if not os.getenv("WEBHOOK_URL"):
         return
-    requests.post(webhook_url, json=data)
+    if _queue is None:
+        with _start_lock:
+            if _queue is None:
+                _queue = queue.Queue(maxsize=int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000")))
+                threading.Thread(target=_run, name="webhooks", daemon=True).start()
+    try:
+        _queue.put_nowait(data)
+    except queue.Full:
+        print("Webhook queue is full, dropping message")
+        metrics.WEBHOOK_FAILURES.inc()
+
+
+def _merge(messages: list[dict]) -> dict:
+    contents = [message["content"] for message in messages if message.get("content")]
+    roles = [role for message in messages for role in message.get("allowed_mentions", {}).get("roles", [])]
+    merged = {
+        "content": " ".join(dict.fromkeys(contents)),  # the same role ping only once
+        "embeds": [embed for message in messages for embed in message.get("embeds", [])]
+    }
+    if roles:
+        merged["allowed_mentions"] = {"roles": list(dict.fromkeys(roles))}
+    return merged
+
+
+def _post(data: dict, max_retries: int | None = None, timeout: float = 10):
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if max_retries is None:
+        max_retries = int(os.getenv("WEBHOOK_MAX_RETRIES", "5"))
+    for attempt in range(max_retries + 1):
+        try:
+            with metrics.timed(metrics.WEBHOOK_LATENCY):
+                response = _session.post(webhook_url, json=data, timeout=timeout)
+        except requests.RequestException as e:
+            print(f"Error sending webhook: {e}")
+            metrics.WEBHOOK_FAILURES.inc()
+            if attempt < max_retries:
+                time.sleep(2 ** attempt)
+            continue
+        if response.ok:
+            return
+        metrics.WEBHOOK_FAILURES.inc()
+        if attempt == max_retries:
+            break
+        if response.status_code == 429:  # rate limited, Discord tells us how long to wait
+            try:
+                retry_after = float(response.json().get("retry_after", 1))
+            except ValueError:
+                retry_after = float(response.headers.get("Retry-After", 1))
+            time.sleep(retry_after)
+        elif response.status_code >= 500:
+            time.sleep(2 ** attempt)
+        else:
+            print(f"Webhook rejected ({response.status_code}): {response.text}")
+            return
+    print("Giving up on webhook after too many retries")
+
+
+def _run():
+    global _in_flight
+    carry = None  # message that didn't fit into the previous batch
+    while True:
+        batch = [carry if carry is not None else _queue.get()]
+        _in_flight = batch  # everything taken off the queue stays visible to _flush until it is sent
+        carry = None
+        embeds = len(batch[0].get("embeds", []))
+        deadline = time.monotonic() + float(os.getenv("WEBHOOK_BATCH_WINDOW", "1.0"))
+        while embeds < MAX_EMBEDS:
+            try:
+                message = _queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if embeds + len(message.get("embeds", [])) > MAX_EMBEDS:
+                carry = message
+                _in_flight = batch + [carry]
+                break
+            batch.append(message)
+            embeds += len(message.get("embeds", []))
+        try:
+            _post(_merge(batch) if len(batch) > 1 else batch[0])
+        except Exception as e:
+            print(f"Error sending webhook: {e}")
+        _in_flight = [carry] if carry is not None else None
+
+
+@atexit.register
+def _flush():
+    # Best effort on shutdown: the batch being sent and everything still queued, one attempt each and no longer than
+    # WEBHOOK_SHUTDOWN_TIMEOUT seconds overall, so the worker exits within gunicorn's graceful timeout.
+    # The in-flight batch may be sent twice if the sender thread gets it through meanwhile, rather than lost.
+    messages = list(_in_flight or [])
+    while _queue is not None:
+        try:
+            messages.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    batches: list[list[dict]] = []
+    for message in messages:
+        if not batches or sum(len(m.get("embeds", [])) for m in batches[-1] + [message]) > MAX_EMBEDS:
+            batches.append([])
+        batches[-1].append(message)
+
+    deadline = time.monotonic() + float(os.getenv("WEBHOOK_SHUTDOWN_TIMEOUT", "5"))
+    for batch in batches:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            print("Webhook shutdown timeout reached, dropping the remaining messages")
+            return
+        try:
+            _post(_merge(batch) if len(batch) > 1 else batch[0], max_retries=0, timeout=remaining)
+        except Exception as e:
+            print(f"Error sending webhook: {e}")
 
 
 # def blocking_instance_removed(domain: str, isp: str):
@@ -0,0 +1,65 @@
+import atexit
+import os
+import threading
+
+import database
+import notifications
+
+__all__ = ["add"]
+
+# Write-behind buffer for the potentially_blocked table. Requests only check a local set of known domains and
+# queue new ones, a background thread writes them in one transaction per batch and sends the notifications
+# for the domains that really were new.
+_known: set[str] = set()
+_buffer: list[str] = []
+_lock = threading.Lock()
+_wake = threading.Event()
+_thread: threading.Thread | None = None
+
+
+def add(domain: str):
+    global _thread
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_run, name="potentially-blocked", daemon=True)
+            _thread.start()
+        if domain in _known:
+            return
+        _known.add(domain)
+        _buffer.append(domain)
+        if len(_buffer) >= int(os.getenv("POTENTIALLY_BLOCKED_BATCH", "50")):
+            _wake.set()
+
+
+def _flush():
+    global _buffer
+    with _lock:
+        batch, _buffer = _buffer, []
+    if not batch:
+        return
+    try:
+        # another worker may have stored the same domain since, only the rows inserted here are notified
+        new_domains = database.add_potentially_blocked_domains(batch)
+    except Exception as e:
+        print(f"Error storing potentially blocked domains, retrying later: {e}")
+        with _lock:
+            _buffer = batch + _buffer
+        return
+    for domain in new_domains:
+        notifications.domain_potentially_blocked(domain)
+
+
+def _run():
+    try:
+        known = database.get_potentially_blocked_domains()
+        with _lock:
+            _known.update(known)
+    except Exception as e:
+        print(f"Error loading potentially blocked domains: {e}")
+    while True:
+        _wake.wait(float(os.getenv("POTENTIALLY_BLOCKED_FLUSH_INTERVAL", "2.0")))
+        _wake.clear()
+        _flush()
+
+
+atexit.register(_flush)
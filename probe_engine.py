@@ -0,0 +1,209 @@
+import asyncio
+import os
+import random
+import socket
+import threading
+
+from async_dns import Address
+from async_dns.core import types
+
+import dns_wire
+import transports as conn_transports
+
+__all__ = ["ProbeEngine", "get_engine", "close_engine", "forget"]
+
+
+class _ProbeProtocol(asyncio.DatagramProtocol):
+    def __init__(self, engine: "ProbeEngine"):
+        self.engine = engine
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        self.engine.on_datagram(data, addr)
+
+    def error_received(self, exc: Exception):
+        print(f"Probe socket error: {exc}")
+
+
+class ProbeEngine:
+    # Long-lived UDP engine: a small pool of sockets per address family shared by every probe on one event loop.
+    # Responses are matched to their query by (source ip, source port, query id) and must repeat the query's question,
+    # so a late reply to an earlier query that happened to use the same id isn't taken as the answer.
+    # Resolvers with another protocol (tcp, tcps, https) use a persistent connection from the transports module instead.
+    def __init__(self, sockets_per_family: int = 1):
+        self.loop = asyncio.get_running_loop()
+        self.sockets_per_family = max(1, sockets_per_family)
+        self._transports: dict[int, list[asyncio.DatagramTransport]] = {}
+        self._opening: dict[int, asyncio.Future] = {}
+        self._next_socket = 0
+        self._pending: dict[tuple[bytes, int, int], tuple[asyncio.Future, bytes | None]] = {}  # -> future, question
+        self._resolved: dict[Address, tuple[int, str, int]] = {}
+        self._connections: dict[Address, conn_transports.Transport] = {}
+
+    async def _resolve(self, address: Address) -> tuple[int, str, int]:
+        resolved = self._resolved.get(address)
+        if resolved is None:
+            host, port = address.to_addr()
+            port = port or 53
+            if address.ip_type is types.AAAA:
+                resolved = (socket.AF_INET6, host, port)
+            elif address.ip_type is types.A:
+                resolved = (socket.AF_INET, host, port)
+            else:  # hostname, resolve it once so replies can be matched by source address
+                infos = await self.loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+                family, _, _, _, sockaddr = infos[0]
+                resolved = (family, sockaddr[0], port)
+            self._resolved[address] = resolved
+        return resolved
+
+    async def _get_transports(self, family: int) -> list[asyncio.DatagramTransport]:
+        transports = self._transports.get(family)
+        if transports is not None:
+            return transports
+        opening = self._opening.get(family)
+        if opening is None:
+            opening = asyncio.ensure_future(self._open_sockets(family))
+            self._opening[family] = opening
+        try:
+            return await asyncio.shield(opening)
+        finally:
+            if opening.done():
+                self._opening.pop(family, None)
+
+    async def _open_sockets(self, family: int) -> list[asyncio.DatagramTransport]:
+        transports = []
+        for _ in range(self.sockets_per_family):
+            transport, _ = await self.loop.create_datagram_endpoint(lambda: _ProbeProtocol(self), family=family)
+            transports.append(transport)
+        self._transports[family] = transports
+        return transports
+
+    def on_datagram(self, data: bytes, addr: tuple):
+        if len(data) < 12:
+            return
+        host, port = addr[0], addr[1]
+        try:
+            packed = socket.inet_pton(socket.AF_INET6 if ":" in host else socket.AF_INET, host)
+        except OSError:
+            return
+        key = (packed, port, int.from_bytes(data[:2], "big"))
+        pending = self._pending.get(key)
+        if pending is None:
+            return
+        future, question = pending
+        if question is not None and dns_wire.question(data) != question:
+            return  # not the answer to this query, keep waiting
+        del self._pending[key]
+        if not future.done():
+            future.set_result(data)
+
+    async def send(self, data: bytes, address: Address, timeout: float, hedge_after: float | None = None) -> bytes:
+        # data is a packed DNS query. If there is no answer after hedge_after seconds, a second copy of the query
+        # is sent and whichever answer arrives first is used. One dropped packet then doesn't cost a timeout.
+        if address.protocol not in (None, "udp"):
+            # no hedging, the connection doesn't drop single queries
+            transport = self._connections.get(address)
+            if transport is None:
+                transport = self._connections[address] = conn_transports.Transport(address)
+            return await transport.send(data, timeout)
+        if hedge_after is None or hedge_after >= timeout:
+            return await self._send_once(data, address, timeout)
+
+        first = asyncio.ensure_future(self._send_once(data, address, timeout))
+        second = None
+        try:
+            done, _ = await asyncio.wait({first}, timeout=hedge_after)
+            if done:
+                return first.result()
+            second = asyncio.ensure_future(self._send_once(data, address, timeout - hedge_after))
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            return first.result()  # both failed, raise the first error
+        finally:
+            first.cancel()
+            if second is not None:
+                second.cancel()
+
+    async def _send_once(self, data: bytes, address: Address, timeout: float) -> bytes:
+        # the query ID is replaced by one that is unique for the target address
+        family, host, port = await self._resolve(address)
+        transports = await self._get_transports(family)
+        packed = socket.inet_pton(family, host)
+        while True:
+            qid = random.getrandbits(16)
+            key = (packed, port, qid)
+            if key not in self._pending:
+                break
+        future = self.loop.create_future()
+        pending = self._pending[key] = (future, dns_wire.question(data))
+        try:
+            transport = transports[self._next_socket % len(transports)]
+            self._next_socket += 1
+            transport.sendto(qid.to_bytes(2, "big") + data[2:], (host, port))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+
+    def forget(self, address: Address):
+        self._resolved.pop(address, None)
+        transport = self._connections.pop(address, None)
+        if transport is not None:
+            try:
+                self.loop.call_soon_threadsafe(transport.close)  # called from the config reload thread
+            except RuntimeError:  # the loop is already closed
+                pass
+
+    def close(self):
+        for future, _ in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        for transports in self._transports.values():
+            for transport in transports:
+                try:
+                    transport.close()
+                except RuntimeError:  # the loop is already closed
+                    pass
+        self._transports.clear()
+        for transport in self._connections.values():
+            try:
+                transport.close()
+            except RuntimeError:  # the loop is already closed
+                pass
+        self._connections.clear()
+
+
+_engines: dict[asyncio.AbstractEventLoop, ProbeEngine] = {}
+_engines_lock = threading.Lock()  # loops may run in different threads
+
+
+def get_engine() -> ProbeEngine:
+    loop = asyncio.get_running_loop()
+    with _engines_lock:
+        engine = _engines.get(loop)
+        if engine is None:
+            for stale_loop in [stale_loop for stale_loop in _engines if stale_loop.is_closed()]:
+                _engines.pop(stale_loop).close()
+            engine = ProbeEngine(int(os.getenv("PROBE_SOCKETS", "1")))
+            _engines[loop] = engine
+    return engine
+
+
+def close_engine():
+    # close the engine of the running loop, needed for short-lived loops (asyncio.run)
+    loop = asyncio.get_running_loop()
+    with _engines_lock:
+        engine = _engines.pop(loop, None)
+    if engine is not None:
+        engine.close()
+
+
+def forget(address: Address):
+    # drop cached state of a resolver that was removed
+    with _engines_lock:
+        engines = list(_engines.values())
+    for engine in engines:
+        engine.forget(address)
@@ -0,0 +1,72 @@
+import cProfile
+import json
+import os
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
+
+from flask import Request, Response, g, has_request_context
+
+__all__ = ["phase", "start_request", "finish_request", "teardown_request"]
+
+# Lightweight phase timing for request handlers. Every request gets a Server-Timing header, TIMING_LOG=1 also
+# prints one JSON line per request. A sample of requests (PROFILE_SAMPLE_RATE, or the X-Profile header carrying
+# PROFILE_KEY) is profiled with cProfile and dumped to PROFILE_DIR.
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context():
+            g.setdefault("timings", []).append((name, time.perf_counter() - start_time))
+
+
+def _should_profile(request: Request) -> bool:
+    if not os.getenv("PROFILE_DIR"):
+        return False
+    profile_key = os.getenv("PROFILE_KEY")
+    if profile_key and request.headers.get("X-Profile") == profile_key:
+        return True
+    return random.random() < float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+
+
+def start_request(request: Request):
+    g.request_start = time.perf_counter()
+    if _should_profile(request):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def finish_request(request: Request, response: Response) -> Response:
+    if "request_start" not in g:
+        return response
+    total = time.perf_counter() - g.request_start
+    timings = g.get("timings", [])
+
+    response.headers["Server-Timing"] = ", ".join(
+        [f"{name};dur={duration * 1000:.1f}" for name, duration in timings] + [f"total;dur={total * 1000:.1f}"]
+    )
+    if os.getenv("TIMING_LOG"):
+        print(json.dumps({
+            "path": request.path,
+            "status": response.status_code,
+            "total_ms": round(total * 1000, 1),
+            "phases": {name: round(duration * 1000, 1) for name, duration in timings}
+        }))
+    return response
+
+
+def teardown_request(request: Request):
+    # runs even if the handler raised, otherwise the profiler would stay enabled on this (reused) thread
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return
+    profiler.disable()
+    # several threads of one worker can finish a profiled request within the same second
+    file_name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{request.endpoint}-{uuid.uuid4().hex[:8]}.prof"
+    profiler.dump_stats(os.path.join(os.getenv("PROFILE_DIR"), file_name))
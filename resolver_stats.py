@@ -0,0 +1,180 @@
+import os
+import threading
+import time
+from array import array
+
+from async_dns import Address
+
+import shared_state
+
+__all__ = ["record", "record_health", "timeout_for", "hedge_delay_for", "get_stats", "forget", "export",
+           "read_workers", "start_publishing"]
+
+# Latency and outcome history per resolver, fed by every probe (health checks, sweeps and user requests).
+# It drives the per-resolver probe timeout and when a hedged retry is sent, and is reported on /resolvers.
+# Each worker only sees its own probes, so every worker publishes a summary of its rings and the scheduler merges
+# them into the /resolvers figures.
+WINDOW = 512  # recent probes per resolver
+HEALTH_WINDOW = 1440  # recent health checks per resolver, one day at one check per minute
+MIN_SAMPLES = 20  # below this we don't trust the estimate and use the ceiling
+
+
+class _Ring:
+    # fixed-size ring buffer of probe latencies (ms) and outcomes, stored in arrays instead of objects
+    __slots__ = ("latencies", "answered", "next", "count", "version", "misses", "_sorted", "_sorted_version")
+
+    def __init__(self, size: int):
+        self.latencies = array("H", bytes(2 * size))
+        self.answered = array("B", bytes(size))
+        self.next = 0
+        self.count = 0
+        self.version = 0
+        self.misses = 0  # lost probes since the last answered one
+        self._sorted: list[int] = []
+        self._sorted_version = -1
+
+    def add(self, latency: int, answered: bool):
+        self.latencies[self.next] = min(latency, 0xFFFF)
+        self.answered[self.next] = answered
+        self.next = (self.next + 1) % len(self.answered)
+        self.count = min(self.count + 1, len(self.answered))
+        self.version += 1
+        self.misses = 0 if answered else self.misses + 1
+
+    def answered_latencies(self) -> list[int]:
+        # sorted latencies of answered probes, only re-sorted every few samples
+        if self._sorted_version < 0 or self.version - self._sorted_version >= 8:
+            self._sorted = sorted(
+                self.latencies[i] for i in range(self.count) if self.answered[i]
+            )
+            self._sorted_version = self.version
+        return self._sorted
+
+    def loss_rate(self) -> float | None:
+        if self.count == 0:
+            return None
+        return 1 - sum(self.answered[:self.count]) / self.count
+
+
+_probes: dict[Address, _Ring] = {}
+_health: dict[Address, _Ring] = {}  # only the outcome (reachable) is used
+_lock = threading.Lock()  # may be used from more than one thread
+
+
+def _ring(rings: dict[Address, _Ring], address: Address, size: int) -> _Ring:
+    ring = rings.get(address)
+    if ring is None:
+        ring = rings[address] = _Ring(size)
+    return ring
+
+
+def record(address: Address, duration: int, answered: bool):
+    # duration in ms, for lost probes the timeout
+    with _lock:
+        _ring(_probes, address, WINDOW).add(duration, answered)
+
+
+def record_health(address: Address, reachable: bool):
+    with _lock:
+        _ring(_health, address, HEALTH_WINDOW).add(0, reachable)
+
+
+def _percentile(ordered: list[int], percentile: float) -> int | None:
+    if len(ordered) < MIN_SAMPLES:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile))]
+
+
+def _percentiles(address: Address, *percentiles: float) -> list[int | None]:
+    with _lock:
+        ring = _probes.get(address)
+        ordered = ring.answered_latencies() if ring is not None else []
+    return [_percentile(ordered, percentile) for percentile in percentiles]
+
+
+def timeout_for(address: Address) -> float:
+    # p99 plus a margin, clamped to [floor, ceiling], in seconds. Lost probes have no latency, so the p99 can't see
+    # a resolver that became slower than the timeout. Every lost probe in a row doubles the timeout instead, until
+    # answers arrive again and the p99 has caught up
+    floor = float(os.getenv("PROBE_TIMEOUT_FLOOR", "0.5"))
+    ceiling = float(os.getenv("PROBE_TIMEOUT_CEILING", "3.0"))
+    p99, = _percentiles(address, 0.99)
+    if p99 is None:
+        return ceiling
+    with _lock:
+        ring = _probes.get(address)
+        misses = ring.misses if ring is not None else 0
+    timeout = p99 / 1000 * 1.5 + float(os.getenv("PROBE_TIMEOUT_MARGIN", "0.2"))
+    return min(ceiling, max(floor, timeout) * 2 ** min(misses, 16))
+
+
+def hedge_delay_for(address: Address) -> float | None:
+    # send a second query if the first one hasn't been answered well within the usual latency (2x p95)
+    p95, = _percentiles(address, 0.95)
+    if p95 is None:
+        return None
+    return max(0.05, p95 / 1000 * 2)
+
+
+def _summary(ring: _Ring) -> dict[str, list[int] | int]:
+    answered = sum(ring.answered[:ring.count])
+    return {"latencies": ring.answered_latencies(), "probes": ring.count, "lost": ring.count - answered}
+
+
+def export() -> dict[str, dict[str, list[int] | int]]:
+    # this worker's probes per resolver address, as published to the other workers
+    with _lock:
+        return {str(address): _summary(ring) for address, ring in _probes.items()}
+
+
+def _publish_interval() -> float:
+    return float(os.getenv("RESOLVER_STATS_INTERVAL", "30"))
+
+
+def read_workers() -> list[dict[str, dict[str, list[int] | int]]]:
+    # the exports of the other workers, those that stopped publishing are left out
+    return shared_state.read_workers("probes", 3 * _publish_interval())
+
+
+def start_publishing():
+    def run():
+        while True:
+            time.sleep(_publish_interval())
+            try:
+                shared_state.publish_worker("probes", export())
+            except Exception as e:
+                print(f"Error publishing resolver statistics: {e}")
+
+    threading.Thread(target=run, name="resolver-stats", daemon=True).start()
+
+
+def get_stats(address: Address, workers: list[dict] | None = None) -> dict[str, int | float | None]:
+    # the probes of this process merged with those of the other workers (see read_workers), uptime only comes from
+    # this process, the health checks run in the scheduler
+    with _lock:
+        probes = _probes.get(address)
+        health = _health.get(address)
+        summary = _summary(probes) if probes is not None else {"latencies": [], "probes": 0, "lost": 0}
+        health_loss = health.loss_rate() if health is not None else None
+    ordered, count, lost = list(summary["latencies"]), summary["probes"], summary["lost"]
+    for worker in workers or []:
+        other = worker.get(str(address))
+        if other is not None:
+            ordered.extend(other["latencies"])
+            count += other["probes"]
+            lost += other["lost"]
+    ordered.sort()
+    p50, p95, p99 = (_percentile(ordered, percentile) for percentile in (0.5, 0.95, 0.99))
+    return {
+        "p50": p50,
+        "p95": p95,
+        "p99": p99,
+        "loss_rate": round(lost / count, 4) if count else None,
+        "uptime": round(1 - health_loss, 4) if health_loss is not None else None
+    }
+
+
+def forget(address: Address):
+    with _lock:
+        _probes.pop(address, None)
+        _health.pop(address, None)
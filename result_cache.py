@@ -0,0 +1,70 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+import data_types as t
+import dns
+
+__all__ = ["ResultCache", "get_cache"]
+
+
+class ResultCache:
+    # TTL + LRU cache for full checks, keyed by normalized domain.
+    # Concurrent lookups of the same uncached domain share one in-flight probe.
+    # Not thread safe, only use it from the worker's shared event loop.
+    def __init__(self, ttl: float, error_ttl: float, max_size: int):
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[str, tuple[float, t.FullProbeResponse]] = OrderedDict()
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    def _ttl_for(self, result: t.FullProbeResponse) -> float:
+        # results with errors, timeouts, pending or skipped resolvers may be incomplete, don't keep them for long
+        incomplete = any(response.response in dns.NO_ANSWER for response in result.responses)
+        return self.error_ttl if incomplete or result.final_result == t.FullProbeResponseType.ERROR else self.ttl
+
+    def _store(self, domain: str, future: asyncio.Future):
+        self._in_flight.pop(domain, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        self._entries[domain] = (time.monotonic(), future.result())
+        self._entries.move_to_end(domain)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, domain: str, probe: Callable[[], Awaitable[t.FullProbeResponse]]) \
+            -> tuple[t.FullProbeResponse, float]:
+        # returns the result and its age in seconds
+        entry = self._entries.get(domain)
+        if entry is not None:
+            created, result = entry
+            age = time.monotonic() - created
+            if age < self._ttl_for(result):
+                self._entries.move_to_end(domain)
+                return result, age
+            del self._entries[domain]
+
+        future = self._in_flight.get(domain)
+        if future is None:
+            future = asyncio.ensure_future(probe())
+            self._in_flight[domain] = future
+            future.add_done_callback(lambda f: self._store(domain, f))
+        # shield, so one waiting request going away doesn't cancel the probe for everyone else
+        return await asyncio.shield(future), 0.0
+
+
+_cache: ResultCache | None = None
+
+
+def get_cache() -> ResultCache:
+    global _cache
+    if _cache is None:
+        _cache = ResultCache(
+            float(os.getenv("RESULT_CACHE_TTL", "300")),
+            float(os.getenv("RESULT_CACHE_ERROR_TTL", "30")),
+            int(os.getenv("RESULT_CACHE_SIZE", "10000"))
+        )
+    return _cache
@@ -0,0 +1,103 @@
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+__all__ = ["acquire_scheduler_lock", "publish", "read", "publish_worker", "read_workers"]
+
+# Every gunicorn worker imports the app, but only the worker holding the scheduler lock runs the background tasks.
+# It publishes its results to a JSON file, which every worker reads (and caches until the file changes).
+# The other way round, every worker publishes what only it knows (its probe statistics) to a file of its own.
+# Paths are resolved lazily, the .env file is only loaded after the imports in app.py.
+
+
+def _state_dir() -> str:
+    return os.getenv("STATE_DIR", tempfile.gettempdir())
+
+
+def _state_path() -> str:
+    return os.path.join(_state_dir(), "cuiiliste_state.json")
+
+
+def _worker_path(pid: int) -> str:
+    return os.path.join(_state_dir(), f"cuiiliste_worker_{pid}.json")
+
+
+_lock_fd: int | None = None
+_published: dict = {}
+_worker_published: dict = {}
+_publish_lock = threading.Lock()
+_cache: tuple[tuple[int, int], dict] | None = None
+
+
+def acquire_scheduler_lock():
+    # blocks until this process is the scheduler. The OS releases the lock when the holder dies,
+    # so a waiting worker takes over automatically.
+    global _lock_fd
+    fd = os.open(os.path.join(_state_dir(), "cuiiliste_scheduler.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode())
+    _lock_fd = fd  # keep the fd open for as long as the process lives
+
+
+def _write(path: str, state: dict):
+    # atomically replace the file, readers never see a partial write
+    fd, tmp_path = tempfile.mkstemp(dir=_state_dir(), prefix=".cuiiliste_state")
+    with os.fdopen(fd, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def publish(key: str, value):
+    with _publish_lock:
+        _published[key] = value
+        _write(_state_path(), _published)
+
+
+def publish_worker(key: str, value):
+    with _publish_lock:
+        _worker_published[key] = value
+        _write(_worker_path(os.getpid()), _worker_published)
+
+
+def read_workers(key: str, max_age: float) -> list:
+    # the values of all other workers that published within max_age seconds. Older files are left behind by
+    # workers that died, they are removed
+    values = []
+    now = time.time()
+    for name in os.listdir(_state_dir()):
+        if not name.startswith("cuiiliste_worker_") or name == os.path.basename(_worker_path(os.getpid())):
+            continue
+        path = os.path.join(_state_dir(), name)
+        try:
+            if now - os.stat(path).st_mtime > max_age:
+                os.remove(path)
+                continue
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if key in state:
+            values.append(state[key])
+    return values
+
+
+def read(key: str, default=None):
+    global _cache
+    try:
+        stat = os.stat(_state_path())
+    except FileNotFoundError:
+        return default
+    version = (stat.st_mtime_ns, stat.st_size)
+    cache = _cache
+    if cache is None or cache[0] != version:
+        try:
+            with open(_state_path()) as f:
+                cache = (version, json.load(f))
+        except (OSError, ValueError):
+            return default
+        _cache = cache
+    return cache[1].get(key, default)
@@ -0,0 +1,60 @@
+from array import array
+
+import data_types as t
+import dns
+
+__all__ = ["SweepMatrix"]
+
+_BLOCKED = t.SingleProbeResponseType.BLOCKED.value
+_NOT_BLOCKED = t.SingleProbeResponseType.NOT_BLOCKED.value
+_TIMEOUT = t.SingleProbeResponseType.TIMEOUT.value
+
+
+class SweepMatrix:
+    # Outcomes of a background batch as a domains x resolvers matrix, one byte (SingleProbeResponseType value)
+    # and one uint16 latency in ms per probe, instead of a SingleProbeResponse object per probe.
+    # Row i holds the probes of domains[i], in the order of resolvers.
+    __slots__ = ("domains", "resolvers", "codes", "latencies")
+
+    def __init__(self, domains: list[str], resolvers: list[t.DNSResolver]):
+        self.domains = domains
+        self.resolvers = resolvers
+        self.codes = array("B", bytes(len(domains) * len(resolvers)))  # 0: not probed
+        self.latencies = array("H", bytes(2 * len(domains) * len(resolvers)))
+
+    def set(self, row: int, column: int, response: t.SingleProbeResponseType, duration: int):
+        index = row * len(self.resolvers) + column
+        self.codes[index] = response.value
+        self.latencies[index] = min(duration, 0xFFFF)
+
+    def row(self, row: int) -> bytes:
+        width = len(self.resolvers)
+        return self.codes[row * width:(row + 1) * width].tobytes()
+
+    def classify(self, row: int) -> t.FullProbeResponseType:
+        # same result as dns.analyze_results, from the counts of the row
+        codes = self.row(row)
+        return dns.category(codes.count(_BLOCKED) > 0, codes.count(_NOT_BLOCKED) > 0)
+
+    def classify_all(self) -> list[t.FullProbeResponseType]:
+        return [self.classify(row) for row in range(len(self.domains))]
+
+    def timeouts(self) -> dict[str, int]:
+        # timeouts per resolver name, counted over each column
+        width = len(self.resolvers)
+        timeouts = {resolver.name: 0 for resolver in self.resolvers}
+        for column, resolver in enumerate(self.resolvers):
+            timeouts[resolver.name] += self.codes[column::width].count(_TIMEOUT)
+        return timeouts
+
+    def median_latencies(self) -> dict[str, int | None]:
+        # median latency (ms) of the answered probes per resolver name, None if none answered
+        width = len(self.resolvers)
+        answered: dict[str, list[int]] = {resolver.name: [] for resolver in self.resolvers}
+        for column, resolver in enumerate(self.resolvers):
+            answered[resolver.name].extend(
+                latency for code, latency in zip(self.codes[column::width], self.latencies[column::width])
+                if code == _BLOCKED or code == _NOT_BLOCKED
+            )
+        return {name: sorted(latencies)[len(latencies) // 2] if latencies else None
+                for name, latencies in answered.items()}
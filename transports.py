@@ -0,0 +1,230 @@
+import asyncio
+import os
+import random
+import ssl
+from collections import deque
+
+from async_dns import Address
+
+__all__ = ["PROTOCOLS", "Transport"]
+
+# Connection-oriented probe transports: DNS over TCP (RFC 7766), over TLS (RFC 7858) and over HTTPS (RFC 8484).
+# Every resolver gets one persistent connection that is shared by all probes. Queries are pipelined on it: TCP and
+# TLS replies are matched by query id, DoH replies arrive in request order (HTTP/1.1 keep-alive). A connection that
+# fails to open is retried with exponential backoff, probes during the backoff fail right away.
+CONNECT_TIMEOUT = 5.0
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+# dns_resolvers.protocol -> (tls, http), the names async_dns uses. "tcps" is DNS over TLS, port 853 by default
+PROTOCOLS = {
+    "tcp": (False, False),
+    "tcps": (True, False),
+    "https": (True, True),
+}
+
+
+def _ssl_context(http: bool) -> ssl.SSLContext:
+    context = ssl.create_default_context()
+    if os.getenv("PROBE_TLS_VERIFY", "1") == "0":  # ISP resolvers addressed by IP often have no matching certificate
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if http:
+        context.set_alpn_protocols(["http/1.1"])
+    return context
+
+
+class _StreamConnection:
+    # length-prefixed DNS messages, any number in flight, replies matched by query id
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self._pending: dict[int, asyncio.Future] = {}
+        self._read_task = asyncio.ensure_future(self._read_loop(reader))
+
+    def is_open(self) -> bool:
+        return not self._read_task.done()
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                length = int.from_bytes(await reader.readexactly(2), "big")
+                data = await reader.readexactly(length)
+                future = self._pending.pop(int.from_bytes(data[:2], "big"), None)
+                if future is not None and not future.done():
+                    future.set_result(data)
+        except (asyncio.IncompleteReadError, OSError):
+            pass  # closed by the server, idle connections are closed after a while
+        finally:
+            self._close(ConnectionResetError("Connection closed"))
+
+    async def query(self, data: bytes, timeout: float) -> bytes:
+        # the query ID is replaced by one that is unique on this connection
+        if not self.is_open():
+            raise ConnectionResetError("Connection closed")
+        while True:
+            qid = random.getrandbits(16)
+            if qid not in self._pending:
+                break
+        future = asyncio.get_running_loop().create_future()
+        self._pending[qid] = future
+        try:
+            self.writer.write(len(data).to_bytes(2, "big") + qid.to_bytes(2, "big") + data[2:])
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if self._pending.get(qid) is future:
+                del self._pending[qid]
+
+    def _close(self, error: Exception):
+        self.writer.close()
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+
+    def close(self):
+        self._read_task.cancel()
+
+
+class _HttpConnection:
+    # DoH POSTs of application/dns-message, pipelined, the responses come back in request order
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, address: Address):
+        self.writer = writer
+        host, port = address.to_addr()
+        host = f"[{host}]" if ":" in host else host
+        self._host = host if port in (None, 443) else f"{host}:{port}"
+        self._path = address.path or "/dns-query"
+        self._waiting: deque[asyncio.Future] = deque()
+        self._read_task = asyncio.ensure_future(self._read_loop(reader))
+
+    def is_open(self) -> bool:
+        return not self._read_task.done()
+
+    async def _read_response(self, reader: asyncio.StreamReader) -> tuple[int, bytes, bool]:
+        # returns (status, body, keep-alive)
+        status_line = await reader.readuntil(b"\r\n")
+        status = int(status_line.split()[1])
+        headers = {}
+        while (line := await reader.readuntil(b"\r\n")) != b"\r\n":
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = b""
+            while size := int((await reader.readuntil(b"\r\n")).split(b";")[0], 16):
+                body += await reader.readexactly(size)
+                await reader.readexactly(2)
+            while await reader.readuntil(b"\r\n") != b"\r\n":  # trailers
+                pass
+        else:
+            body = await reader.readexactly(int(headers.get("content-length", "0")))
+        return status, body, headers.get("connection", "").lower() != "close"
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        try:
+            keep_alive = True
+            while keep_alive:
+                status, body, keep_alive = await self._read_response(reader)
+                if not self._waiting:
+                    break  # a response nobody asked for, the connection is out of sync
+                future = self._waiting.popleft()
+                if future.done():  # the probe timed out meanwhile
+                    continue
+                if status == 200:
+                    future.set_result(body)
+                else:
+                    future.set_exception(RuntimeError(f"DoH request failed with status {status}"))
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, IndexError, OSError):
+            pass
+        finally:
+            self._close(ConnectionResetError("Connection closed"))
+
+    async def query(self, data: bytes, timeout: float) -> bytes:
+        if not self.is_open():
+            raise ConnectionResetError("Connection closed")
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append(future)  # stays queued on timeout, its response still has to be read
+        self.writer.write(
+            f"POST {self._path} HTTP/1.1\r\n"
+            f"Host: {self._host}\r\n"
+            f"Content-Type: application/dns-message\r\n"
+            f"Accept: application/dns-message\r\n"
+            f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+        )
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            future.cancel()  # no-op if it is done
+
+    def _close(self, error: Exception):
+        self.writer.close()
+        for future in self._waiting:
+            if not future.done():
+                future.set_exception(error)
+        self._waiting.clear()
+
+    def close(self):
+        self._read_task.cancel()
+
+
+class Transport:
+    # the persistent connection to one resolver, reopened when the server closed it
+    def __init__(self, address: Address):
+        if address.protocol not in PROTOCOLS:
+            raise ValueError(f"Unsupported protocol {address.protocol!r}")
+        self.address = address
+        self.tls, self.http = PROTOCOLS[address.protocol]
+        self._connection: _StreamConnection | _HttpConnection | None = None
+        self._opening: asyncio.Future | None = None
+        self._failures = 0
+        self._retry_at = 0.0
+
+    async def _open(self) -> _StreamConnection | _HttpConnection:
+        loop = asyncio.get_running_loop()
+        if loop.time() < self._retry_at:
+            raise ConnectionRefusedError(f"Reconnecting to {self.address} is backing off")
+        host, port = self.address.to_addr()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                host, port, ssl=_ssl_context(self.http) if self.tls else None
+            ), CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            self._failures += 1
+            self._retry_at = loop.time() + min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self._failures - 1))
+            raise ConnectionRefusedError(f"Could not connect to {self.address}: {e!r}") from e
+        self._failures = 0
+        if self.http:
+            return _HttpConnection(reader, writer, self.address)
+        return _StreamConnection(reader, writer)
+
+    async def _get_connection(self) -> _StreamConnection | _HttpConnection:
+        if self._connection is not None and self._connection.is_open():
+            return self._connection
+        opening = self._opening
+        if opening is None:
+            opening = self._opening = asyncio.ensure_future(self._open())
+            # the error is raised to the waiting probes, if they gave up already nobody retrieves it
+            opening.add_done_callback(lambda future: future.cancelled() or future.exception())
+        try:
+            self._connection = await asyncio.shield(opening)
+            return self._connection
+        finally:
+            if opening.done() and self._opening is opening:
+                self._opening = None
+
+    async def send(self, data: bytes, timeout: float) -> bytes:
+        # data is a packed DNS query. A query lost because the server closed an idle connection is sent again
+        # on a new connection, connection failures raise a ConnectionError
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        for attempt in range(2):
+            connection = await asyncio.wait_for(self._get_connection(), max(0.0, deadline - loop.time()))
+            try:
+                return await connection.query(data, max(0.0, deadline - loop.time()))
+            except ConnectionResetError:
+                if attempt == 1:
+                    raise
+
+    def close(self):
+        if self._opening is not None:
+            self._opening.cancel()
+        if self._connection is not None:
+            self._connection.close()